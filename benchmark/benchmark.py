@@ -0,0 +1,473 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This script benchmarks create_master_index.py and search_master_index.py against a synthetic corpus, so a change to either can be timed without the
+corpora (or the paths) on the CRC. Every run with the same parameters generates the same corpus:
+
+    vocabulary  vocabulary_size made-up words, drawn with Zipfian frequencies (exponent zipf_exponent), a few of them with accented letters
+    variants    variant_fraction of the words have early modern variant spellings (u/v, i/y, a final e, ...), which the documents use
+                variant_usage_rate of the time, and which are written to a variants list in the format of aggregate_variants.txt
+    documents   number_of_documents texts of log-normally distributed length (mean_document_words words), each saved in an encoding drawn from
+                document_encodings, along with an ecco-style metadata file that gives each text an author, a title and a publication year
+    query text  query_text_words words to search, a mixture of random words and phrases lifted from the documents, so that windows find matches
+
+Each of build_configurations is then built in a process of its own, which reports its throughput (documents and megabytes per second), its peak
+resident memory, and the stage timings of its instrumentation. The index built by the first configuration is searched once for every combination of
+window_lengths, proximity_values and variant_settings, timing each rolling window. Everything is written as json to a results file named for the
+current commit, so two commits can be compared with:
+
+Usage: python benchmark.py
+       python benchmark.py old_results.json new_results.json'''
+
+from os import path
+import codecs, bisect, json, math, multiprocessing, os, platform, random, resource, shutil, subprocess, sys, time
+
+#create_master_index.py, search_master_index.py and run_instrumentation.py live in sibling directories
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "create_master_index"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "search_master_index"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "run_instrumentation"))
+import create_master_index
+import search_master_index
+from run_instrumentation import RunInstrumentation
+
+
+################################
+# Specify Benchmark Parameters #
+################################
+
+#the corpus, the indices and the results are all written beneath benchmark_directory, and the corpus is only generated again when its parameters change
+benchmark_directory    = "benchmark_run"
+random_seed            = 1
+
+vocabulary_size        = 20000
+zipf_exponent          = 1.1
+variant_fraction       = 0.05
+variant_usage_rate     = 0.3
+
+number_of_documents    = 200
+mean_document_words    = 5000
+document_length_sigma  = 1.0
+document_encodings     = [("utf-8", 0.85), ("latin-1", 0.10), ("cp1252", 0.05)]
+
+query_text_words       = 500
+quoted_phrase_fraction = 0.3
+
+#each build configuration is a name and the create_master_index.py parameters to change for it. Parameters that shape the schema (text_store_desired,
+#shingle_field_desired, passage_indexing_desired) are read when create_master_index.py is imported, so benchmark those by changing them in the script itself
+build_configurations   = [
+    ("serial",   {}),
+    ("parallel", {"parallel_build_desired": 1}),
+]
+
+#the search is run once for every combination of these search_master_index.py parameters. The query cache is left off unless query_cache_desired is 1,
+#so that a window repeated in the query text is timed like any other
+window_lengths         = [2, 3, 4]
+proximity_values       = [2, 8, 16]
+variant_settings       = [0, 1]
+query_cache_desired    = 0
+
+
+#####################
+# Generate a Corpus #
+#####################
+
+#the letters words are made of, with the accented letters every encoding in document_encodings can represent
+onsets        = ["b", "br", "c", "ch", "d", "f", "g", "gr", "h", "l", "m", "n", "p", "r", "s", "st", "sh", "t", "th", "v", "w"]
+nuclei        = ["a", "e", "i", "o", "u", "ea", "ou", "ai", "oo"]
+accented      = [u"é", u"è", u"à", u"ç", u"æ", u"ö"]
+variant_rules = [("u", "v"), ("v", "u"), ("i", "y"), ("y", "i"), ("ea", "e"), ("oo", "o")]
+
+
+def make_vocabulary(rng):
+
+    '''Return a list of vocabulary_size distinct unicode words, most frequent first'''
+
+    vocabulary = []
+    seen_words = set()
+    while len(vocabulary) < vocabulary_size:
+
+        #frequent words are short, as they are in English
+        number_of_syllables = 1 + min(int(rng.expovariate(1.0) + len(vocabulary) * 4.0 / vocabulary_size), 5)
+        word = u"".join(rng.choice(onsets) + rng.choice(nuclei) for k in xrange(number_of_syllables))
+        if rng.random() < 0.02:
+            word += rng.choice(accented)
+        if word not in seen_words:
+            seen_words.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+def make_variants(rng, vocabulary):
+
+    '''Return a dictionary mapping variant_fraction of the words in vocabulary to the list of their variant spellings'''
+
+    variants = {}
+    vocabulary_words = set(vocabulary)
+    for word in vocabulary:
+        if rng.random() >= variant_fraction:
+            continue
+        spellings = []
+        for original, replacement in variant_rules:
+            if original in word:
+                spellings.append( word.replace(original, replacement, 1) )
+        spellings.append( word + u"e" )
+        spellings = [spelling for spelling in spellings if spelling not in vocabulary_words]
+        if spellings:
+            variants[word] = sorted(set(spellings))
+    return variants
+
+
+def find_cumulative_weights():
+
+    '''Return the running totals of the Zipfian weights of the vocabulary, for drawing words with bisect'''
+
+    cumulative_weights = []
+    total = 0.0
+    for rank in xrange(1, vocabulary_size + 1):
+        total += 1.0 / rank ** zipf_exponent
+        cumulative_weights.append(total)
+    return cumulative_weights
+
+
+def draw_words(rng, vocabulary, variants, cumulative_weights, number_of_words):
+
+    '''Return number_of_words words drawn from vocabulary with Zipfian frequencies, each word with variants spelled as one of them variant_usage_rate of the time'''
+
+    words = []
+    for k in xrange(number_of_words):
+        word = vocabulary[ bisect.bisect_left(cumulative_weights, rng.random() * cumulative_weights[-1]) ]
+        if word in variants and rng.random() < variant_usage_rate:
+            word = rng.choice(variants[word])
+        words.append(word)
+    return words
+
+
+def format_as_text(rng, words):
+
+    '''Return words joined into sentences of 5 to 25 words, with the occasional comma, ten sentences to a paragraph'''
+
+    sentences = []
+    k = 0
+    while k < len(words):
+        sentence_length = rng.randint(5, 25)
+        sentence_words = words[k:k+sentence_length]
+        sentence_words[0] = sentence_words[0].capitalize()
+        sentence = u" ".join(word + (u"," if rng.random() < 0.05 else u"") for word in sentence_words)
+        sentences.append(sentence.rstrip(u",") + u".")
+        k += sentence_length
+    return u"\n\n".join(u" ".join(sentences[k:k+10]) for k in xrange(0, len(sentences), 10)) + u"\n"
+
+
+def find_corpus_parameters():
+
+    '''Return the parameters that determine the generated corpus'''
+
+    return dict(random_seed=random_seed, vocabulary_size=vocabulary_size, zipf_exponent=zipf_exponent, variant_fraction=variant_fraction,
+        variant_usage_rate=variant_usage_rate, number_of_documents=number_of_documents, mean_document_words=mean_document_words,
+        document_length_sigma=document_length_sigma, document_encodings=document_encodings, query_text_words=query_text_words,
+        quoted_phrase_fraction=quoted_phrase_fraction)
+
+
+def generate_corpus(corpus_dir):
+
+    '''Write the synthetic corpus (texts, metadata, variants list and query text) to corpus_dir, unless the corpus already there was generated with the
+    same parameters. Returns a description of the corpus'''
+
+    corpus_parameters = find_corpus_parameters()
+    description_path = path.join(corpus_dir, "corpus.json")
+    if path.isfile(description_path):
+        with open(description_path) as description_in:
+            corpus_description = json.load(description_in)
+        if corpus_description["parameters"] == json.loads(json.dumps(corpus_parameters)):
+            return corpus_description
+        shutil.rmtree(corpus_dir)
+
+    print "generating the synthetic corpus in", corpus_dir
+    text_dir = path.join(corpus_dir, "ecco")
+    os.makedirs(text_dir)
+
+    rng = random.Random(random_seed)
+    vocabulary = make_vocabulary(rng)
+    variants = make_variants(rng, vocabulary)
+    cumulative_weights = find_cumulative_weights()
+
+    #the document lengths are log-normal, with mean_document_words as their mean
+    mu = math.log(mean_document_words) - document_length_sigma ** 2 / 2.0
+    cumulative_encoding_weights = []
+    for encoding, weight in document_encodings:
+        cumulative_encoding_weights.append( weight + (cumulative_encoding_weights[-1] if cumulative_encoding_weights else 0.0) )
+
+    quoted_phrases = []
+    total_words = 0
+    total_bytes = 0
+    encoding_counts = {}
+    with open(path.join(corpus_dir, "metadata.csv"), "w") as metadata_out:
+        for document_number in xrange(number_of_documents):
+            document_words = draw_words(rng, vocabulary, variants, cumulative_weights, max(10, int(rng.lognormvariate(mu, document_length_sigma))))
+            encoding = document_encodings[ bisect.bisect_left(cumulative_encoding_weights, rng.random() * cumulative_encoding_weights[-1]) ][0]
+
+            text_filename = "ecco_%05d" % document_number
+            encoded_text = format_as_text(rng, document_words).encode(encoding)
+            with open(path.join(text_dir, text_filename + ".txt"), "wb") as text_out:
+                text_out.write(encoded_text)
+
+            #the metadata follows TCPtexts.csv: year, filename, three unused columns, author, two unused columns, title
+            metadata_out.write("%d,%s,x,x,x,Author %d,x,x,Title %d\n" % (rng.randint(1600, 1800), text_filename, document_number % 50, document_number))
+
+            start = rng.randint(0, len(document_words) - 8)
+            quoted_phrases.append( document_words[start : start + rng.randint(3, 8)] )
+
+            total_words += len(document_words)
+            total_bytes += len(encoded_text)
+            encoding_counts[encoding] = encoding_counts.get(encoding, 0) + 1
+
+    with codecs.open(path.join(corpus_dir, "variants.txt"), "w", "utf-8") as variants_out:
+        for word in sorted(variants):
+            variants_out.write( u"\t".join([word] + variants[word]) + u"\n" )
+
+    #the query text interleaves random words with phrases lifted from the documents
+    query_words = []
+    while len(query_words) < query_text_words:
+        if rng.random() < quoted_phrase_fraction:
+            query_words.extend( rng.choice(quoted_phrases) )
+        else:
+            query_words.extend( draw_words(rng, vocabulary, {}, cumulative_weights, rng.randint(3, 8)) )
+    with codecs.open(path.join(corpus_dir, "query_text.txt"), "w", "utf-8") as query_out:
+        query_out.write( format_as_text(rng, query_words[:query_text_words]) )
+
+    corpus_description = dict(parameters=corpus_parameters, documents=number_of_documents, words=total_words, bytes=total_bytes,
+        encodings=encoding_counts, words_with_variants=len(variants))
+    with open(description_path, "w") as description_out:
+        json.dump(corpus_description, description_out, indent=2, sort_keys=True)
+    return json.loads(json.dumps(corpus_description))
+
+
+#####################
+# Benchmark a Build #
+#####################
+
+def find_directory_bytes(directory):
+
+    '''Return the total size of the files beneath directory'''
+
+    return sum( path.getsize(path.join(root, filename)) for root, dirs, filenames in os.walk(directory) for filename in filenames )
+
+
+def find_peak_rss_mb():
+
+    '''Return the peak resident memory, in megabytes, of this process or any of its finished children, whichever is larger. Linux reports ru_maxrss in kilobytes'''
+
+    return max( resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss ) / 1024.0
+
+
+def run_build(corpus_dir, index_dir, build_parameters, result_queue):
+
+    '''Process function: build index_dir from the corpus in corpus_dir with build_parameters applied to create_master_index.py, and put the build's
+    measurements on result_queue'''
+
+    #the build prints a line per file, which would swamp the benchmark's own output
+    sys.stdout = open(os.devnull, "w")
+
+    for parameter, value in build_parameters.items():
+        setattr(create_master_index, parameter, value)
+    create_master_index.text_dirs = [path.join(corpus_dir, "ecco")]
+    create_master_index.instrumentation = RunInstrumentation()
+
+    create_master_index.metadata_registry.register_source("ecco", path.join(corpus_dir, "metadata.csv"), create_master_index.parse_ecco_metadata)
+    create_master_index.metadata_registry.refresh()
+
+    text_files = create_master_index.find_text_files()
+    build_started = time.time()
+    create_master_index.build_index(index_dir, text_files)
+    build_seconds = time.time() - build_started
+
+    build_report = create_master_index.instrumentation.report()
+    result_queue.put(dict(seconds=build_seconds, peak_rss_mb=find_peak_rss_mb(), stages=build_report["stages"], counters=build_report["counters"]))
+
+
+def benchmark_build(corpus_dir, corpus_description, configuration_name, build_parameters):
+
+    '''Build the corpus with one build configuration in a fresh process, so its peak memory is its own, and return its measurements'''
+
+    index_dir = path.join(benchmark_directory, "index_" + configuration_name)
+    if path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+
+    result_queue = multiprocessing.Queue()
+    build_process = multiprocessing.Process(target=run_build, args=(corpus_dir, index_dir, build_parameters, result_queue))
+    build_process.start()
+    build_result = result_queue.get()
+    build_process.join()
+
+    build_result.update(
+        configuration=configuration_name,
+        parameters=build_parameters,
+        documents_per_second=corpus_description["documents"] / build_result["seconds"],
+        mb_per_second=corpus_description["bytes"] / float(1 << 20) / build_result["seconds"],
+        index_mb=find_directory_bytes(index_dir) / float(1 << 20),
+        index_dir=index_dir)
+
+    print "build %-12s %8.2fs  %8.1f docs/s  %6.2f MB/s  peak rss %7.1f MB" % (configuration_name, build_result["seconds"],
+        build_result["documents_per_second"], build_result["mb_per_second"], build_result["peak_rss_mb"])
+    return build_result
+
+
+######################
+# Benchmark a Search #
+######################
+
+def find_percentile(sorted_values, percentile):
+
+    '''Return the nearest-rank percentile of sorted_values, or None if there are none'''
+
+    if not sorted_values:
+        return None
+    return sorted_values[ min(len(sorted_values) - 1, int(math.ceil(percentile / 100.0 * len(sorted_values))) - 1) ]
+
+
+def benchmark_search(corpus_dir, index_dir, search_window_length, search_proximity_value, search_variant_setting):
+
+    '''Search index_dir for every rolling window of the query text with one combination of search parameters, and return the latency of each window
+    along with the totals and stage timings of the run'''
+
+    search_master_index.input_text_path = path.join(corpus_dir, "query_text.txt")
+    search_master_index.index_directory = index_dir
+    search_master_index.variants_path = path.join(corpus_dir, "variants.txt")
+    search_master_index.compiled_variants_path = path.join(corpus_dir, "variants.idx")
+    search_master_index.window_length = search_window_length
+    search_master_index.proximity_value = search_proximity_value
+    search_master_index.variant_spelling_desired = search_variant_setting
+    search_master_index.query_cache_size = search_master_index.query_cache_size if query_cache_desired == 1 else 0
+    search_master_index.persistent_query_cache_desired = 0
+    search_master_index.instrumentation = RunInstrumentation()
+
+    rolling_windows = search_master_index.find_rolling_windows( search_master_index.load_input_text() )
+    query_result_cache = search_master_index.create_query_result_cache()
+
+    search_started = time.time()
+    searcher, index_generation = search_master_index.open_searcher()
+    open_seconds = time.time() - search_started
+
+    window_seconds = []
+    number_of_matches = 0
+    number_of_skips = 0
+    with searcher:
+        for i, window_words in rolling_windows:
+            window_started = time.time()
+            window_matches, window_skips = search_master_index.search_window(searcher, index_generation, query_result_cache, window_words)
+            window_seconds.append(time.time() - window_started)
+            number_of_matches += len(window_matches)
+            number_of_skips += len(window_skips)
+    search_seconds = time.time() - search_started
+    query_result_cache.close()
+
+    sorted_window_seconds = sorted(window_seconds)
+    search_report = search_master_index.instrumentation.report()
+    search_result = dict(
+        window_length=search_window_length,
+        proximity_value=search_proximity_value,
+        variant_spelling_desired=search_variant_setting,
+        windows=len(window_seconds),
+        matches=number_of_matches,
+        skipped_queries=number_of_skips,
+        seconds=search_seconds,
+        searcher_open_seconds=open_seconds,
+        windows_per_second=len(window_seconds) / search_seconds,
+        window_seconds=dict(mean=sum(window_seconds) / max(len(window_seconds), 1), median=find_percentile(sorted_window_seconds, 50),
+            p90=find_percentile(sorted_window_seconds, 90), p99=find_percentile(sorted_window_seconds, 99), max=find_percentile(sorted_window_seconds, 100)),
+        stages=search_report["stages"])
+
+    print "search window %d proximity %2d variants %d  %6.1f windows/s  median %7.2fms  p99 %8.2fms  %d matches" % (search_window_length, search_proximity_value,
+        search_variant_setting, search_result["windows_per_second"], 1000 * search_result["window_seconds"]["median"], 1000 * search_result["window_seconds"]["p99"], number_of_matches)
+    return search_result
+
+
+###################
+# Compare Results #
+###################
+
+def find_commit():
+
+    '''Return the commit the repository is at, with a + appended if it has uncommitted changes, or None if it isn't a git checkout'''
+
+    repository_dir = path.dirname(path.dirname(path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repository_dir).strip()
+        if subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repository_dir).strip():
+            commit += "+"
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_results_path(commit):
+
+    '''Get an unused results file name, so we don't write over the results of an earlier run. Write the commit into the file name'''
+
+    results_integer = 0
+    results_path = path.join(benchmark_directory, "benchmark_results_" + (commit or "unknown")[:12] + "_" + str(results_integer) + ".json")
+    while path.isfile(results_path):
+        results_integer += 1
+        results_path = path.join(benchmark_directory, "benchmark_results_" + (commit or "unknown")[:12] + "_" + str(results_integer) + ".json")
+    return results_path
+
+
+def compare_results(old_results_path, new_results_path):
+
+    '''Print the ratio of new to old for each build's throughput and memory and each search's latencies, matching builds by configuration and searches by parameters'''
+
+    with open(old_results_path) as old_in:
+        old_results = json.load(old_in)
+    with open(new_results_path) as new_in:
+        new_results = json.load(new_in)
+
+    print "comparing", old_results["commit"], "with", new_results["commit"], "(new / old, so below 1.0 is faster for seconds and above 1.0 is faster for rates)"
+    if old_results["corpus"]["parameters"] != new_results["corpus"]["parameters"]:
+        print "warning: the two runs used different corpora"
+
+    old_builds = dict( (build["configuration"], build) for build in old_results["builds"] )
+    for build in new_results["builds"]:
+        old_build = old_builds.get(build["configuration"])
+        if old_build:
+            print "build %-12s docs/s %5.2fx  MB/s %5.2fx  peak rss %5.2fx" % (build["configuration"], build["documents_per_second"] / old_build["documents_per_second"],
+                build["mb_per_second"] / old_build["mb_per_second"], build["peak_rss_mb"] / old_build["peak_rss_mb"])
+
+    search_key = lambda search: (search["window_length"], search["proximity_value"], search["variant_spelling_desired"])
+    old_searches = dict( (search_key(search), search) for search in old_results["searches"] )
+    for search in new_results["searches"]:
+        old_search = old_searches.get(search_key(search))
+        if old_search:
+            print "search window %d proximity %2d variants %d  median %5.2fx  p90 %5.2fx  p99 %5.2fx  matches %d -> %d" % (search_key(search) + (
+                search["window_seconds"]["median"] / old_search["window_seconds"]["median"], search["window_seconds"]["p90"] / old_search["window_seconds"]["p90"],
+                search["window_seconds"]["p99"] / old_search["window_seconds"]["p99"], old_search["matches"], search["matches"]))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 3:
+        compare_results(sys.argv[1], sys.argv[2])
+        sys.exit()
+
+    if not path.isdir(benchmark_directory):
+        os.makedirs(benchmark_directory)
+
+    corpus_dir = path.join(benchmark_directory, "corpus")
+    corpus_description = generate_corpus(corpus_dir)
+    print "corpus: %d documents, %d words, %.1f MB" % (corpus_description["documents"], corpus_description["words"], corpus_description["bytes"] / float(1 << 20))
+
+    builds = [benchmark_build(corpus_dir, corpus_description, configuration_name, build_parameters) for configuration_name, build_parameters in build_configurations]
+
+    searches = []
+    for search_window_length in window_lengths:
+        for search_proximity_value in proximity_values:
+            for search_variant_setting in variant_settings:
+                searches.append( benchmark_search(corpus_dir, builds[0]["index_dir"], search_window_length, search_proximity_value, search_variant_setting) )
+
+    commit = find_commit()
+    results = dict(commit=commit, started=time.strftime("%Y-%m-%d %H:%M:%S"), python=platform.python_version(), machine=platform.platform(),
+        cpus=multiprocessing.cpu_count(), corpus=corpus_description, builds=builds, searches=searches)
+
+    results_path = find_results_path(commit)
+    with open(results_path, "w") as results_out:
+        json.dump(results, results_out, indent=2, sort_keys=True)
+    print "results written to", results_path
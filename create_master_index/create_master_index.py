@@ -18,29 +18,122 @@ Byte-strings (type = str) have encoding; unicode text (type = unicode) does not.
 One 'decodes' byte-string into unicode using a method like: unicode(byte_string, encoding_of_bytestring)
 One 'encodes' unicode into byte-strings with a particular encoding using a method like: unicode_string.encode(encoding_to_use)'''
 
-from whoosh.index import create_in
+from whoosh.index import create_in, exists_in, open_dir
+from whoosh.reading import SegmentReader
 from whoosh.fields import *
-import glob, os, chardet, codecs
+from os import path
+import glob, os, chardet, codecs, hashlib, itertools, math, multiprocessing, re, shutil, tempfile, time
 
 def determine_string_encoding(string):
     result = chardet.detect(string)
     string_encoding = result['encoding']
     return string_encoding
 
+def decode_byte_string(string):
+    '''Decode string to unicode, trying strict utf-8 first and only calling chardet if that fails'''
+    try:
+        return string.decode("utf-8")
+    except UnicodeDecodeError:
+        return string.decode(determine_string_encoding(string) or "utf-8", "ignore")
+
+def unicode_path(j):
+    '''Decode the path j to unicode. The index, the manifest, and deletions all rely on this, so a given path always maps to the same unicode value'''
+    return decode_byte_string(j)
+
+###########################################################################################################################################################
+# Decode Texts ############################################################################################################################################
+###########################################################################################################################################################
+
+#files are read in chunks of decoding_chunk_bytes, and chardet only ever sees encoding_sample_bytes of a file that isn't valid utf-8, centred on its first undecodable byte
+decoding_chunk_bytes  = 1 << 20
+encoding_sample_bytes = 1 << 16
+
+#the encoding chardet settles on for a corpus directory is reused for every other non-utf-8 file in that directory
+detected_directory_encodings = {}
+
+#a file that failed strict utf-8 can't be ascii or utf-8, so chardet naming either means it couldn't tell, and the file is decoded as utf-8 with errors ignored
+unusable_fallback_encodings = set(["ascii", "utf-8"])
+
+def decode_file_in_chunks(file_in, encoding, errors):
+    '''Stream file_in through an incremental decoder and return its unicode contents. Raises UnicodeDecodeError if errors is "strict" and the bytes don't
+    decode, with its start and end given as byte offsets within the file'''
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    decoded_chunks = []
+    chunk_offset = 0
+    for chunk in itertools.chain(iter(lambda: file_in.read(decoding_chunk_bytes), ""), [None]):
+
+        #the decoder holds back the bytes of a character split across chunks, and counts them as the start of the next chunk
+        chunk_start = chunk_offset - len(decoder.getstate()[0])
+        try:
+            decoded_chunks.append( decoder.decode("", final=True) if chunk is None else decoder.decode(chunk) )
+        except UnicodeDecodeError as e:
+            e.start += chunk_start
+            e.end += chunk_start
+            raise
+        chunk_offset += len(chunk or "")
+    return u"".join(decoded_chunks)
+
+def find_fallback_encoding(j, file_in, undecodable_offset):
+    '''Return the encoding to use for the non-utf-8 file j, running chardet on a bounded sample around its first undecodable byte only when its
+    directory has no cached encoding'''
+    text_directory = path.dirname(j)
+    if text_directory not in detected_directory_encodings:
+        file_in.seek( max(0, undecodable_offset - encoding_sample_bytes // 2) )
+        encoding_sample = file_in.read(encoding_sample_bytes)
+
+        #a utf-8 text with a stray byte or two still decodes mostly as utf-8, so it is only handed to chardet if more of its non-ascii characters fail to decode than succeed
+        decoded_sample = encoding_sample.decode("utf-8", "replace")
+        undecodable_characters = decoded_sample.count(u"\ufffd")
+        if len(decoded_sample) - len(decoded_sample.encode("ascii", "ignore")) - undecodable_characters > undecodable_characters:
+            return "utf-8"
+
+        with instrumentation.stage("chardet"):
+            detected_encoding = determine_string_encoding(encoding_sample)
+
+        #chardet knows a few encodings (e.g. EUC-TW) that python has no codec for, and those files are decoded as utf-8 with errors ignored too
+        try:
+            detected_codec = codecs.lookup(detected_encoding).name if detected_encoding else None
+        except LookupError:
+            detected_codec = None
+        if detected_codec is None or detected_codec in unusable_fallback_encodings:
+            return "utf-8"
+        detected_directory_encodings[text_directory] = detected_encoding
+    return detected_directory_encodings[text_directory]
+
+def decode_text_file(j):
+    '''Return the unicode contents of the file at path j and the encoding used to decode them'''
+    with open(j, "rb") as file_in:
+
+        #nearly all of our texts are utf-8, so try a strict utf-8 decode before paying for detection
+        try:
+            return decode_file_in_chunks(file_in, "utf-8", "strict"), "utf-8"
+        except UnicodeDecodeError as e:
+            text_content_encoding = find_fallback_encoding(j, file_in, e.start)
+
+        file_in.seek(0)
+        return decode_file_in_chunks(file_in, text_content_encoding, "ignore"), text_content_encoding
+
 ###########################################################################################################################################################
 # Port in Metadata ########################################################################################################################################
 ###########################################################################################################################################################
   
-import glob, codecs
+import glob, codecs, sys
 
-def create_eebo_metadata_dictionary():
+#metadata_registry.py lives alongside this script, and text_normalization.py, text_store.py and run_instrumentation.py in sibling directories
+sys.path.append(path.dirname(path.abspath(__file__)))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "text_normalization"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "text_store"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "run_instrumentation"))
+from metadata_registry import MetadataRegistry
+from run_instrumentation import RunInstrumentation
+from text_normalization import content_analyzer, shingle_analyzer, token_pattern
+from text_store import TextStore
 
-    '''function to create a dictionary of the eebo_tcp metadata containing author, pub_year, and title, keyed to filename'''
+def parse_eebo_metadata(source_path):
 
-    eebo_metadata_dictionary = {}
-    
-    with open("/afs/crc.nd.edu/user/d/dduhaime/data/metadata/TCP_list1.sgm") as eebo_metadata:
-        eebo_metadata = eebo_metadata.readlines()
+    '''generator that reads the eebo_tcp metadata and yields the filename, author, title, and pub_year of each entry'''
+
+    with open(source_path) as eebo_metadata:
         for k in eebo_metadata:
             
             filename = k.split("<ENTRY")[1].split('"')[1].split('"')[0]
@@ -57,23 +150,14 @@ def create_eebo_metadata_dictionary():
             if "-" in publication_year:
                 publication_year = publication_year.split("-")[0]
                 
-            if filename not in eebo_metadata_dictionary.keys():
-                eebo_metadata_dictionary[filename] = {}
-                eebo_metadata_dictionary[filename]["author"] = author.strip()
-                eebo_metadata_dictionary[filename]["title"] = title.strip()
-                eebo_metadata_dictionary[filename]["publication_year"] = publication_year.strip()
-    
-        return eebo_metadata_dictionary
+            yield filename, author.strip(), title.strip(), publication_year.strip()
 
 
-def create_ecco_metadata_dictionary():
+def parse_ecco_metadata(source_path):
     
-    #'''function to create a dictionary of the ecco_tcp metadata containing author, pub_year, and title, keyed to filename'''
+    '''generator that reads the ecco_tcp metadata and yields the filename, author, title, and pub_year of each row'''
 
-    with open("/afs/crc.nd.edu/user/d/dduhaime/data/metadata/TCPtexts.csv") as ecco_metadata:
-        ecco_metadata_dictionary = {}
-        
-        ecco_metadata = ecco_metadata.readlines()
+    with open(source_path) as ecco_metadata:
         for m in ecco_metadata:
             m_s = m.split(",")
             
@@ -82,45 +166,37 @@ def create_ecco_metadata_dictionary():
             title = m_s[8]
             publication_year = m_s[0]
             
-            if filename not in ecco_metadata_dictionary.keys():
-                ecco_metadata_dictionary[filename] = {}
-                ecco_metadata_dictionary[filename]["author"] = author.strip()
-                ecco_metadata_dictionary[filename]["title"] = title.strip()
-                ecco_metadata_dictionary[filename]["publication_year"] = publication_year.strip()
-              
-        return ecco_metadata_dictionary
+            yield filename, author.strip(), title.strip(), publication_year.strip()
 
 
-def create_early_english_drama_metadata_dictionary():
+def parse_early_english_drama_metadata(source_path):
 
-    with open("/afs/crc.nd.edu/user/d/dduhaime/data/metadata/drama_metadata.txt") as metadata_in:
-        
-        early_english_drama_metadata_dictionary = {}
-        
-        metadata_rows = metadata_in.read().split("\r\n")
-        for row in metadata_rows:
-            split_row        = row.split("\t")
+    '''generator that reads the early english drama metadata and yields the filename, author, short title, and pub_year of each row'''
+
+    #the rows are separated by \r\n, which universal newline mode folds into \n
+    with open(source_path, "rU") as metadata_in:
+        for row in metadata_in:
+            split_row        = row.rstrip("\n").split("\t")
             if len(split_row) > 4:
                 filename         = split_row[0].strip()
                 author           = split_row[1].strip()
                 short_title            = split_row[2].strip()
                 publication_year = split_row[4].strip()
             
-            if filename not in early_english_drama_metadata_dictionary.keys():
-                early_english_drama_metadata_dictionary[filename] = {}
-                early_english_drama_metadata_dictionary[filename]["author"]           = author
-                early_english_drama_metadata_dictionary[filename]["title"]            = short_title
-                early_english_drama_metadata_dictionary[filename]["publication_year"] = publication_year
-                
-        return early_english_drama_metadata_dictionary
+                yield filename, author, short_title, publication_year
+        
+        
+def parse_gutenberg_metadata(source_path):
+
+    '''generator that reads the gutenberg metadata and yields the filename, author, and title of each row. Gutenberg doesn't record publication years'''
+
+    with open(source_path, "rU") as gutenberg_metadata:
         
+        #skip the header row
+        next(gutenberg_metadata, None)
         
-def create_gutenberg_metadata_dictionary():
-    with codecs.open("/afs/crc.nd.edu/user/d/dduhaime/data/metadata/gutenberg_metadata.txt") as gutenberg_metadata:
-        gutenberg_metadata_dictionary = {}
-        split_gutenberg_metadata = gutenberg_metadata.read().split("\r\n")
-        for i in split_gutenberg_metadata[1:]:
-            split_i = i.split("\t")
+        for i in gutenberg_metadata:
+            split_i = i.rstrip("\n").split("\t")
             
             if len(split_i) > 3:
             
@@ -128,40 +204,33 @@ def create_gutenberg_metadata_dictionary():
                 gutenberg_author   = split_i[0]
                 gutenberg_title    = split_i[1]
                 
-                if gutenberg_filename not in gutenberg_metadata_dictionary.keys():
-                    gutenberg_metadata_dictionary[gutenberg_filename] = {}
-                    gutenberg_metadata_dictionary[gutenberg_filename]["author"]           = gutenberg_author
-                    gutenberg_metadata_dictionary[gutenberg_filename]["title"]            = gutenberg_title
-                    gutenberg_metadata_dictionary[gutenberg_filename]["publication_year"] = "UNSPECIFIED"
-                    
-        return gutenberg_metadata_dictionary
+                yield gutenberg_filename, gutenberg_author, gutenberg_title, "UNSPECIFIED"
         
         
-def create_latin_library_metadata_dictionary():
-    latin_library_metadata_dictionary = {}
-    for i in glob.glob("/afs/crc.nd.edu/user/d/dduhaime/data/latin_library_single_directory/*.txt"):
+def parse_latin_library_metadata(source_path):
+
+    '''generator that derives the latin library metadata from the names of the files in source_path, which are named for their authors'''
+
+    for i in sorted(glob.glob(source_path + "/*.txt")):
         file_name = i.split("/")[-1].replace(".txt","")
         author = file_name
         title = (file_name + "_corpus").replace(" ","_")
         publication_year = "unspecified"
         
-        if file_name not in latin_library_metadata_dictionary.keys():
-            latin_library_metadata_dictionary[file_name] = {}
-            latin_library_metadata_dictionary[file_name]["author"] = author
-            latin_library_metadata_dictionary[file_name]["title"] = title
-            latin_library_metadata_dictionary[file_name]["publication_year"] = publication_year
-            
-    return latin_library_metadata_dictionary
+        yield file_name, author, title, publication_year
 
 
-eebo_metadata = create_eebo_metadata_dictionary()
-ecco_metadata = create_ecco_metadata_dictionary()
-gutenberg_metadata = create_gutenberg_metadata_dictionary()
-latin_library_metadata = create_latin_library_metadata_dictionary()
+#the registry compiles each metadata source into metadata_registry.sqlite and only re-parses a source when it changes on disk
+metadata_registry = MetadataRegistry("metadata_registry.sqlite")
+metadata_registry.register_source("eebo",      "/afs/crc.nd.edu/user/d/dduhaime/data/metadata/TCP_list1.sgm",             parse_eebo_metadata)
+metadata_registry.register_source("ecco",      "/afs/crc.nd.edu/user/d/dduhaime/data/metadata/TCPtexts.csv",              parse_ecco_metadata)
+metadata_registry.register_source("drama",     "/afs/crc.nd.edu/user/d/dduhaime/data/metadata/drama_metadata.txt",        parse_early_english_drama_metadata)
+metadata_registry.register_source("gutenberg", "/afs/crc.nd.edu/user/d/dduhaime/data/metadata/gutenberg_metadata.txt",    parse_gutenberg_metadata)
+metadata_registry.register_source("latin",     "/afs/crc.nd.edu/user/d/dduhaime/data/latin_library_single_directory",     parse_latin_library_metadata)
 
 ############################################################################################################################################################
-# Create Index #############################################################################################################################################
-############################################################################################################################################################    
+# Specify Indexing Parameters ##############################################################################################################################
+############################################################################################################################################################
 
 #specify a list of paths that contain all of the texts we wish to index
 text_dirs = [
@@ -173,123 +242,631 @@ text_dirs = [
 
 ]
 
+#set parallel_build_desired to 1 to read, decode and analyze the texts in a pool of worker processes. Each worker writes its own segments, which are merged into the final index in file order, so the result matches a serial build
+parallel_build_desired     = 0
+number_of_worker_processes = multiprocessing.cpu_count()
+
+#each worker receives several contiguous shares of the file list, so that a share full of large Gutenberg texts doesn't leave the other workers idle
+shares_per_worker_process  = 4
+
+#the index is written to index_directory. Set sharded_index_desired to 1 to write one shard per corpus instead, each in a subdirectory of index_directory named for
+#its corpus (e.g. index/ecco). Every shard is built, rebuilt, or updated on its own, so set shards_to_build to a list of corpus names (e.g. ["ecco"]) to rebuild just those shards and leave the others as they are
+index_directory              = "index"
+sharded_index_desired        = 0
+shards_to_build              = None
+
+#set incremental_indexing_desired to 1 to update an existing index in place. Only files whose size, mtime, or content hash differ from the manifest are re-indexed, files that have disappeared are deleted, and the index is committed every checkpoint_interval changes so an interrupted build resumes from its last checkpoint
+incremental_indexing_desired = 0
+checkpoint_interval          = 500
+manifest_filename            = "manifest.txt"
+
+#set shingle_field_desired to 1 to also index every run of shingle_size consecutive words as a single term in the content_shingles field. An exact search for a window of shingle_size words is then one term lookup, and longer windows are an intersection of shingle postings
+shingle_field_desired        = 0
+shingle_size                 = 3
+
+#set passage_indexing_desired to 1 to index each text as overlapping passages of passage_length words rather than as one document, so verifying a match only
+#reads the passage it is in. Consecutive passages share passage_overlap words; keep that at least the search script's proximity_value plus its window_length,
+#so that every match falls wholly inside some passage
+passage_indexing_desired     = 0
+passage_length               = 1000
+passage_overlap              = 100
+
+#set memory_budgeted_writer_desired to 1 to bound the memory a build uses. The writer's posting pool spills to disk beyond writer_pool_mb, its segment is
+#flushed to disk (without merging) whenever the text added since the last flush reaches writer_flush_mb, and each file of large_file_bytes or more is
+#written to a segment of its own. The build's final commit merges the smallest segments until at most maximum_final_segments remain
+memory_budgeted_writer_desired = 0
+writer_pool_mb               = 128
+writer_flush_mb              = 256
+large_file_bytes             = 32 << 20
+maximum_final_segments       = 8
+
+#set instrumentation_desired to 1 to time each stage of the build (metadata, decode, chardet, analyze and add, text store, commit, merge shares), count the files,
+#bytes and documents indexed, keep a histogram of the time each file took along with the slowest files, and write all of it to instrumentation_report_path as
+#json at the end of the run. Set progress_line_desired to 1 for a live progress line on stderr
+instrumentation_desired      = 0
+progress_line_desired        = 0
+instrumentation_report_path  = "create_master_index_report.json"
+instrumentation              = RunInstrumentation(instrumentation_desired == 1, progress_line_desired == 1)
+
+#set text_store_desired to 1 to keep the full text of each document in a text store (see text_store.py) in the text_store subdirectory of the index, rather than
+#storing it in the index itself. The search script cuts its snippets from whichever of the two the index has
+text_store_desired           = 1
+text_store_directory_name    = "text_store"
+
 title=TEXT(stored=True, analyzer=analysis.StandardAnalyzer(stoplist=None))
 
-#establish the schema to be used when storing texts; storing content allows us to retrieve hightlighted extracts from texts in which matches occur
-schema = Schema( path=ID(stored=True), encoding=TEXT(stored=True), content=TEXT(stored=True, analyzer=analysis.StandardAnalyzer(stoplist=None)), title=TEXT(stored=True), author=TEXT(stored=True), publication_year=TEXT(stored=True) )
+#establish the schema to be used when storing texts; storing content (here or in the text store) allows us to retrieve extracts from texts in which matches occur. Recording the position
+#and character range of every token in content (phrase=True, chars=True) lets the search script verify matches and cut snippets straight from the postings
+schema = Schema( path=ID(stored=True, unique=True), encoding=TEXT(stored=True), content=TEXT(stored=(text_store_desired != 1), phrase=True, chars=True, analyzer=content_analyzer()), title=TEXT(stored=True), author=TEXT(stored=True), publication_year=TEXT(stored=True) )
 
-#check to see if we already have an index directory. If we don't, make it)
-if not os.path.exists("index"):
-    os.mkdir("index")
-ix = create_in("index", schema)
+#publication_year keeps the metadata as given. year holds it as a number, so the search script can filter and sort by year, and corpus names the corpus each text came from
+schema.add("year", NUMERIC(int, stored=True, sortable=True))
+schema.add("corpus", ID(stored=True))
 
-#create writer object we'll use to write each of the documents in text_dir to the index
-writer = ix.writer()
+#the shingles are tokenized by the content analyzer before they are joined, so they are normalized exactly as content is
+if shingle_field_desired == 1:
+    schema.add( "content_shingles", TEXT(phrase=True, chars=True, analyzer=shingle_analyzer(shingle_size)) )
 
-#for each directory in our list
-for i in text_dirs:
+#each passage records where it begins within its text, so the search script can place its matches in the text as a whole
+if passage_indexing_desired == 1:
+    schema.add( "passage_start", NUMERIC(int, stored=True) )
 
-    #for each text file in that directory (j is now the path to the current file within the current directory)
-    for j in glob.glob( i + "/*.txt" ):
-        
+
+############################################################################################################################################################
+# Prepare Documents ########################################################################################################################################
+############################################################################################################################################################
+
+def find_text_files():
+
+    '''Return the paths of all of the texts in text_dirs. Paths are sorted within each directory so that serial and parallel builds see the files in the same order'''
+
+    text_files = []
+    for i in text_dirs:
+        text_files.extend( sorted( glob.glob( i + "/*.txt" ) ) )
+    return text_files
+
+
+def find_corpus(j):
+
+    '''Return the name of the corpus the text at path j belongs to, or None if j isn't in any of the registered corpora'''
+
+    corpus = None
+    for corpus_name in ["eebo", "ecco", "drama", "gutenberg", "latin"]:
+        if corpus_name in j:
+            corpus = corpus_name
+    return corpus
+
+
+def find_metadata(j, text_filename):
+
+    '''Return the author, title, and publication year of the text at path j, and whether its metadata was found. Texts without metadata are given
+    placeholder values that name the file'''
+
+    try:
+        text_metadata    = metadata_registry.lookup(find_corpus(j), text_filename)
+        author           = text_metadata["author"]
+        title            = text_metadata["title"]
+        publication_year = text_metadata["publication_year"]
+        metadata_found   = True
+
+    #if you get a key error, then the given text doesn't have metadata fields available, so pass appropriate values to variables
+    except KeyError:
+
+        author               = "Metadata Missing. See: " + text_filename
+        title                = "Metadata Missing. See: " + text_filename
+        publication_year     = "Metadata Missing. See: " + text_filename
+        metadata_found       = False
+
+        print "error at 239 with file ", j
+        instrumentation.count("files without metadata")
+
+    return author, title, publication_year, metadata_found
+
+
+def normalize_publication_year(publication_year):
+
+    '''Return the first four-digit year in the publication_year metadata as an int, or None if it doesn't give one (e.g. "UNSPECIFIED")'''
+
+    year_match = re.search(r"\b\d{4}\b", publication_year)
+    if year_match:
+        return int(year_match.group(0))
+
+
+def create_document_fields(j):
+
+    '''Read, decode, and describe the text at path j. Returns a dictionary of unicode field values to pass to writer.add_document, or None if the file could not be prepared'''
+
+    try:
+        #first, let's grab j filename:
+        text_filename = j.split("/")[-1][:-4]
+
+        ####################
+        # Consult Metadata #
+        ####################
+
+        with instrumentation.stage("metadata"):
+            author, title, publication_year, metadata_found = find_metadata(j, text_filename)
+
+        #######################
+        # Index File Segments #
+        #######################
+
+        with instrumentation.stage("decode"):
+            unicode_content, text_content_encoding = decode_text_file(j)
+
+        #decode text_title, path, and text_content to unicode using the encodings we determined for each above
         try:
-            text_content_encoding = "utf-8"
-            
-            #first, let's grab j filename:
-            text_filename = j.split("/")[-1][:-4]
-            
-            ####################
-            # Consult Metadata #
-            ####################
-            
-            try:
-                if "eebo" in j:
-                    author           = eebo_metadata[text_filename]["author"]
-                    title            = eebo_metadata[text_filename]["title"]
-                    publication_year = eebo_metadata[text_filename]["publication_year"]
-                    
-                if "ecco" in j:
-                
-                    author           = ecco_metadata[text_filename]["author"]
-                    title            = ecco_metadata[text_filename]["title"]
-                    publication_year = ecco_metadata[text_filename]["publication_year"]
-                    
-                if "drama" in j:
-                    author           = early_english_metadata[text_filename]["author"]
-                    title            = early_english_metadata[text_filename]["title"]
-                    publication_year = early_english_metadata[text_filename]["publication_year"]
-                    
-                if "gutenberg" in j:
-                    author           = gutenberg_metadata[text_filename]["author"]
-                    title            = gutenberg_metadata[text_filename]["title"]
-                    publication_year = gutenberg_metadata[text_filename]["publication_year"]
-                    
-                if "latin" in j:
-                    author           = latin_library_metadata[text_filename]["author"]
-                    title            = latin_library_metadata[text_filename]["title"]
-                    publication_year = latin_library_metadata[text_filename]["publication_year"]
-                    
-            #if you get a key error, then the given text doesn't have metadata fields available, so pass appropriate values to variables
-            except KeyError:
-            
-                author               = "Metadata Missing. See: " + text_filename
-                title                = "Metadata Missing. See: " + text_filename
-                publication_year     = "Metadata Missing. See: " + text_filename
-                
-                print "error at 239 with file ", j
-                
-            #######################
-            # Index File Segments #
-            #######################
-            
-            with open( j, "r" ) as text_content:  
-                
-                text_content = text_content.read()
-                
-                decoded_content = text_content.decode(text_content_encoding, errors = "ignore")  
-                
-                #use method defined above to determine encoding of path and text_content
-                path_encoding = determine_string_encoding(j)
-                
-                #decode text_title, path, and text_content to unicode using the encodings we determined for each above
-                try:
-			unicode_text_path        = unicode(j, path_encoding)
-		except Error as er:
-			print "error at 258 with file", j, er
-					
-		try:
-			unicode_encoding         = unicode(text_content_encoding)
-		except Error as er:
-			print "error at 263 with file", j, er
-					
-                try:
-			unicode_content          = decoded_content
-		except Error as er:
-			print "error at 268 with file", j, er
-					
-		try:
-			unicode_title            = unicode(title, "utf-8")
-		except Error as er:
-			print "error at 273 with file", j, er
-					
-		try:
-			unicode_author           = unicode(author, "utf-8")
-		except Error as er:
-			print "error at 278 with file", j, er
-                
-		try:
-			unicode_publication_year = unicode(publication_year, "utf-8")
-		except Error as er:
-			print "error at 283 with file", j, er
-                    
-                #use writer method to add document to index
-                writer.add_document( path = unicode_text_path, encoding = unicode_encoding, content = unicode_content, author = unicode_author, title = unicode_title, publication_year = unicode_publication_year )
-                
-            print "loaded ", text_filename
-            
-        #if you hit an error, print j (the error may well be related to the encoding of j)
-        except Exception as e:
+            unicode_text_path        = unicode_path(j)
+        except Exception as er:
+            print "error at 258 with file", j, er
+
+        try:
+            unicode_encoding         = unicode(text_content_encoding)
+        except Exception as er:
+            print "error at 263 with file", j, er
+
+        try:
+            unicode_title            = unicode(title, "utf-8")
+        except Exception as er:
+            print "error at 273 with file", j, er
+
+        try:
+            unicode_author           = unicode(author, "utf-8")
+        except Exception as er:
+            print "error at 278 with file", j, er
+
+        try:
+            unicode_publication_year = unicode(publication_year, "utf-8")
+        except Exception as er:
+            print "error at 283 with file", j, er
+
+        document_fields = dict( path = unicode_text_path, encoding = unicode_encoding, content = unicode_content, author = unicode_author, title = unicode_title, publication_year = unicode_publication_year )
+        document_fields["corpus"] = unicode(find_corpus(j) or "other")
+
+        #texts without a usable year are left out of the year field, so they never fall inside a year range. The placeholder given to a text without
+        #metadata names its file, and a filename such as 1342.txt isn't a year
+        year = normalize_publication_year(publication_year) if metadata_found else None
+        if year is not None:
+            document_fields["year"] = year
+
+        if shingle_field_desired == 1:
+            document_fields["content_shingles"] = unicode_content
+        return document_fields
+
+    #if you hit an error, print j (the error may well be related to the encoding of j)
+    except Exception as e:
+        print j, e
+
+
+def split_into_passages(unicode_content):
+
+    '''Return the (start character, end character) range of each passage of unicode_content. Each passage holds passage_length words, and starts
+    passage_length - passage_overlap words after the one before it'''
+
+    token_ranges = [match.span() for match in token_pattern.finditer(unicode_content)]
+    if not token_ranges:
+        return [(0, len(unicode_content))]
+
+    passage_ranges = []
+    first_token = 0
+    while True:
+        last_token = min(first_token + passage_length, len(token_ranges)) - 1
+        passage_ranges.append( (token_ranges[first_token][0], token_ranges[last_token][1]) )
+        if last_token == len(token_ranges) - 1:
+            return passage_ranges
+        first_token += max(1, passage_length - passage_overlap)
+
+
+def find_indexed_documents(document_fields):
+
+    '''Return the list of documents to add to the index for one text: the text itself, or one document per passage if passage_indexing_desired is set.
+    Each passage carries the path and metadata of its text, along with passage_start, the character at which it begins within the text'''
+
+    if passage_indexing_desired != 1:
+        return [document_fields]
+
+    passages = []
+    for passage_start, passage_end in split_into_passages(document_fields["content"]):
+        passage_fields = dict(document_fields)
+        passage_fields["content"] = document_fields["content"][passage_start:passage_end]
+        passage_fields["passage_start"] = passage_start
+        if shingle_field_desired == 1:
+            passage_fields["content_shingles"] = passage_fields["content"]
+        passages.append(passage_fields)
+    return passages
+
+
+def add_text(writer, document_fields):
+
+    '''Add the documents for one text to the index through writer, and its content to the text store'''
+
+    with instrumentation.stage("analyze and add"):
+        for indexed_document in find_indexed_documents(document_fields):
+            writer.add_document( **indexed_document )
+            instrumentation.count("documents")
+
+    if text_store is not None:
+        with instrumentation.stage("text store"):
+            text_store.put( document_fields["path"], document_fields["content"] )
+
+
+def record_file(j, file_started):
+
+    '''Count the file at path j, which started being indexed at file_started, towards the files, bytes, and per-file latencies of the run'''
+
+    instrumentation.count("files")
+    instrumentation.count("bytes", path.getsize(j))
+    instrumentation.record_latency("file", j, time.time() - file_started)
+
+
+def index_files(ix, writer, text_files):
+
+    '''Add each of the text files to ix through writer, and return the writer to make the final commit with. If the writer's memory is budgeted, its
+    segment is flushed whenever the text added since the last flush reaches writer_flush_mb, and every file of large_file_bytes or more is written to a
+    segment of its own, so no more than one large text is ever buffered at once'''
+
+    buffered_bytes = 0
+    for file_number, j in enumerate(text_files):
+        file_started = time.time()
+        large_file = memory_budgeted_writer_desired == 1 and path.getsize(j) >= large_file_bytes
+        if large_file and buffered_bytes:
+            writer = flush_writer(ix, writer)
+            buffered_bytes = 0
+
+        document_fields = create_document_fields(j)
+
+        #use writer method to add document to index
+        if document_fields:
+            add_text(writer, document_fields)
+            buffered_bytes += len(document_fields["content"]) * unicode_character_bytes
+            print "loaded ", j.split("/")[-1][:-4]
+        else:
+            instrumentation.count("files not indexed")
+
+        record_file(j, file_started)
+        instrumentation.show_progress(file_number + 1, len(text_files), "files")
+
+        if memory_budgeted_writer_desired == 1 and (large_file or buffered_bytes >= writer_flush_mb * (1 << 20)):
+            writer = flush_writer(ix, writer)
+            buffered_bytes = 0
+
+    return writer
+
+
+############################################################################################################################################################
+# Budget Writer Memory #####################################################################################################################################
+############################################################################################################################################################
+
+#the bytes a decoded text occupies in memory for each of its characters
+unicode_character_bytes = 4 if sys.maxunicode > 0xffff else 2
+
+def open_writer(ix):
+
+    '''Return a writer for ix. If the writer's memory is budgeted, whoosh's posting pool is held to writer_pool_mb before it spills to disk'''
+
+    if memory_budgeted_writer_desired == 1:
+        return ix.writer(limitmb=writer_pool_mb)
+    return ix.writer()
+
+
+def flush_writer(ix, writer):
+
+    '''Commit the segment writer has buffered, without merging it into any other segment, and return a new writer for ix'''
+
+    with instrumentation.stage("commit"):
+        if text_store is not None:
+            text_store.commit()
+        writer.commit(merge=False)
+    return open_writer(ix)
+
+
+def merge_to_segment_limit(writer, segments):
+
+    '''Whoosh mergetype function: merge the smallest of segments into the segment writer is writing until at most maximum_final_segments remain, and return the segments left as they are'''
+
+    if len(segments) <= maximum_final_segments:
+        return segments
+
+    sorted_segments = sorted(segments, key=lambda segment: segment.doc_count_all())
+    number_of_segments_to_merge = len(segments) - maximum_final_segments + 1
+    for segment in sorted_segments[:number_of_segments_to_merge]:
+        segment_reader = SegmentReader(writer.storage, writer.schema, segment)
+        try:
+            writer.add_reader(segment_reader)
+        finally:
+            segment_reader.close()
+    return sorted_segments[number_of_segments_to_merge:]
+
+
+def commit_writer(writer):
+
+    '''Make the final commit of a build. If the writer's memory is budgeted, the segments flushed along the way are merged down to maximum_final_segments'''
+
+    with instrumentation.stage("commit"):
+        if text_store is not None:
+            text_store.commit()
+        if memory_budgeted_writer_desired == 1:
+            writer.commit(mergetype=merge_to_segment_limit)
+        else:
+            writer.commit()
+
+
+############################################################################################################################################################
+# Parallel Build ###########################################################################################################################################
+############################################################################################################################################################
+
+def split_into_shares(text_files, number_of_shares):
+
+    '''Split text_files into at most number_of_shares contiguous lists. Keeping each share contiguous lets us merge the worker segments back in file order'''
+
+    share_size = max(1, int(math.ceil(len(text_files) / float(number_of_shares))))
+    return [text_files[k:k+share_size] for k in xrange(0, len(text_files), share_size)]
+
+
+def initialize_build_worker():
+
+    '''Pool initializer: a worker is forked with everything the parent's instrumentation has recorded so far, which the parent would otherwise get back
+    in the worker's first snapshot, so each worker starts its instrumentation afresh'''
+
+    instrumentation.reset()
+
+
+def index_file_share(share_arguments):
+
+    '''Worker function: write one share of the text files to its own index within segment_directory and return the path to that index, along with
+    what the worker's instrumentation recorded for the share'''
+
+    share_number, share_files, segment_directory = share_arguments
+
+    share_index_directory = path.join(segment_directory, "share_" + str(share_number))
+    os.mkdir(share_index_directory)
+    share_ix = create_in(share_index_directory, schema)
+    share_writer = index_files(share_ix, open_writer(share_ix), share_files)
+
+    #each worker appends to a text store data file of its own, which commit_writer flushes before the parent merges the share
+    commit_writer(share_writer)
+    return share_index_directory, instrumentation.take_snapshot()
+
+
+def merge_share_indices(writer, share_index_directories):
+
+    '''Copy the documents written by the workers into the final index, one share at a time and in share order'''
+
+    for share_index_directory in share_index_directories:
+        share_reader = open_dir(share_index_directory).reader()
+        try:
+            writer.add_reader(share_reader)
+        finally:
+            share_reader.close()
+
+
+def build_index_in_parallel(writer, text_files):
+
+    '''Index text_files with a pool of worker processes, then merge the segments they wrote into writer'''
+
+    #keep the worker indices in the working directory (next to the final index) so the merge doesn't have to cross filesystems
+    segment_directory = tempfile.mkdtemp(prefix="worker_segments_", dir=".")
+
+    try:
+        shares = split_into_shares(text_files, number_of_worker_processes * shares_per_worker_process)
+        share_arguments = [(share_number, share_files, segment_directory) for share_number, share_files in enumerate(shares)]
+
+        pool = multiprocessing.Pool(number_of_worker_processes, initialize_build_worker)
+        try:
+            #imap hands back the share indices in share order, even when the shares finish out of order
+            share_index_directories = []
+            for share_index_directory, share_snapshot in pool.imap(index_file_share, share_arguments, chunksize=1):
+                share_index_directories.append(share_index_directory)
+                instrumentation.add_snapshot(share_snapshot)
+                instrumentation.show_progress(sum(len(share_files) for share_files in shares[:len(share_index_directories)]), len(text_files), "files")
+        finally:
+            pool.close()
+            pool.join()
+
+        with instrumentation.stage("merge shares"):
+            merge_share_indices(writer, share_index_directories)
+
+    finally:
+        shutil.rmtree(segment_directory, ignore_errors=True)
+
+
+############################################################################################################################################################
+# Incremental Build ########################################################################################################################################
+############################################################################################################################################################
+
+def find_manifest_path(index_dir):
+
+    '''Return the path of the manifest kept for the index in index_dir'''
+
+    return path.join(index_dir, manifest_filename)
+
+
+def read_manifest(manifest_path):
+
+    '''Read the manifest at manifest_path into a dictionary keyed to path. Each value is a (size, mtime, content hash) tuple'''
+
+    manifest = {}
+    if path.isfile(manifest_path):
+        with open(manifest_path) as manifest_in:
+            for row in manifest_in:
+                split_row = row.rstrip("\n").split("\t")
+                if len(split_row) == 4:
+                    manifest[split_row[0]] = tuple(split_row[1:])
+    return manifest
+
+
+def write_manifest(manifest, manifest_path):
+
+    '''Write the manifest to a temporary file and then rename it into place, so a crash mid-write never leaves a truncated manifest behind'''
+
+    with open(manifest_path + ".tmp", "w") as manifest_out:
+        for j in sorted(manifest):
+            manifest_out.write( "\t".join( (j,) + manifest[j] ) + "\n" )
+    os.rename(manifest_path + ".tmp", manifest_path)
+
+
+def hash_file_contents(j):
+
+    '''Return the sha1 hex digest of the file at path j, reading it in one megabyte chunks'''
+
+    content_hash = hashlib.sha1()
+    with open(j, "rb") as file_in:
+        for chunk in iter(lambda: file_in.read(1 << 20), ""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def fingerprint_file(j, previous_fingerprint):
+
+    '''Return the (size, mtime, content hash) fingerprint of the file at path j. If size and mtime match previous_fingerprint, the file is not read again'''
+
+    file_stat = os.stat(j)
+    size, mtime = str(file_stat.st_size), repr(file_stat.st_mtime)
+
+    if previous_fingerprint and previous_fingerprint[:2] == (size, mtime):
+        return previous_fingerprint
+
+    return (size, mtime, hash_file_contents(j))
+
+
+def update_index_incrementally(ix, text_files, manifest_path):
+
+    '''Bring ix up to date with text_files, re-indexing only the files that changed since the manifest at manifest_path was written and deleting the files that have disappeared'''
+
+    manifest = read_manifest(manifest_path)
+    current_files = set(text_files)
+    writer = open_writer(ix)
+    changes_since_checkpoint = 0
+    buffered_bytes = 0
+
+    def checkpoint(writer):
+        #commit the text store, then the index, then the manifest, so the manifest never claims a file the index doesn't have and the index never holds a document without its text
+        writer = flush_writer(ix, writer)
+        write_manifest(manifest, manifest_path)
+        return writer
+
+    #delete the documents whose files have been removed from text_dirs
+    for j in sorted(manifest):
+        if j not in current_files:
+            writer.delete_by_term("path", unicode_path(j))
+            if text_store is not None:
+                text_store.delete(unicode_path(j))
+            del manifest[j]
+            changes_since_checkpoint += 1
+            print "deleted ", j.split("/")[-1][:-4]
+
+    for file_number, j in enumerate(text_files):
+        instrumentation.show_progress(file_number + 1, len(text_files), "files")
+        file_started = time.time()
+        previous_fingerprint = manifest.get(j)
+        try:
+            fingerprint = fingerprint_file(j, previous_fingerprint)
+        except (IOError, OSError) as e:
             print j, e
-            
-#after you've added all of your documents, commit changes to the index
-writer.commit()
+            continue
+
+        #if only the mtime moved, record the new fingerprint but leave the document alone
+        if previous_fingerprint and fingerprint[2] == previous_fingerprint[2]:
+            manifest[j] = fingerprint
+            continue
+
+        document_fields = create_document_fields(j)
+        if document_fields:
+            #replace any earlier version of this file (all of its passages, if it was split into passages)
+            writer.delete_by_term("path", document_fields["path"])
+            add_text(writer, document_fields)
+            record_file(j, file_started)
+            manifest[j] = fingerprint
+            changes_since_checkpoint += 1
+            buffered_bytes += len(document_fields["content"]) * unicode_character_bytes
+            print "loaded ", j.split("/")[-1][:-4]
+
+        if changes_since_checkpoint >= checkpoint_interval or (memory_budgeted_writer_desired == 1 and buffered_bytes >= writer_flush_mb * (1 << 20)):
+            writer = checkpoint(writer)
+            changes_since_checkpoint = 0
+            buffered_bytes = 0
+
+    commit_writer(writer)
+    write_manifest(manifest, manifest_path)
+
+
+############################################################################################################################################################
+# Create Index #############################################################################################################################################
+############################################################################################################################################################
+
+#the text store that index_files and update_index_incrementally write to, opened by build_index for the index it is building
+text_store = None
+
+
+def build_index(index_dir, text_files):
+
+    '''Build the index in index_dir from text_files, either updating it in place or replacing it, as the indexing parameters ask'''
+
+    global text_store
+
+    #check to see if we already have an index directory. If we don't, make it)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    #a full rebuild starts a new text store, since every text is about to be written again
+    text_store_dir = path.join(index_dir, text_store_directory_name)
+    if incremental_indexing_desired != 1 and path.isdir(text_store_dir):
+        shutil.rmtree(text_store_dir)
+    text_store = TextStore(text_store_dir) if text_store_desired == 1 else None
+
+    #an incremental build updates the existing index and commits as it goes, so it manages its own writers
+    if incremental_indexing_desired == 1:
+        if exists_in(index_dir):
+            ix = open_dir(index_dir)
+        else:
+            ix = create_in(index_dir, schema)
+        update_index_incrementally(ix, text_files, find_manifest_path(index_dir))
+
+    else:
+        #a full rebuild replaces the index, so any manifest from an earlier incremental build no longer describes it
+        ix = create_in(index_dir, schema)
+        if path.isfile(find_manifest_path(index_dir)):
+            os.remove(find_manifest_path(index_dir))
+
+        #create writer object we'll use to write each of the documents in text_dir to the index
+        writer = open_writer(ix)
+
+        if parallel_build_desired == 1:
+            build_index_in_parallel(writer, text_files)
+        else:
+            writer = index_files(ix, writer, text_files)
+
+        #after you've added all of your documents, commit changes to the text store and then to the index
+        commit_writer(writer)
+
+    if text_store is not None:
+        text_store.close()
+
+
+def find_shard_files(text_files):
+
+    '''Return a dictionary mapping each shard name to the texts in text_files that belong in it, in the order text_files gives them. Texts outside the registered corpora go in the "other" shard'''
+
+    shard_files = {}
+    for j in text_files:
+        shard_files.setdefault(find_corpus(j) or "other", []).append(j)
+    return shard_files
+
+
+if __name__ == "__main__":
+
+    #recompile any metadata source that has changed since the last run
+    for corpus in metadata_registry.refresh():
+        print "compiled metadata for ", corpus
+
+    if sharded_index_desired == 1:
+        shard_files = find_shard_files(find_text_files())
+        for shard_name in sorted(shard_files):
+            if shards_to_build is None or shard_name in shards_to_build:
+                print "building shard ", shard_name
+                build_index(path.join(index_directory, shard_name), shard_files[shard_name])
+
+    else:
+        build_index(index_directory, find_text_files())
+
+    instrumentation.write_report(instrumentation_report_path)
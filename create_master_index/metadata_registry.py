@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+'''This module keeps the corpus metadata (author, title, and publication year, keyed to filename) in a single sqlite file, so that create_master_index.py
+doesn't have to parse every metadata source on every run.
+
+Each source is registered with a corpus name, the path of the file (or directory) it is parsed from, and a parser. A parser is a generator that reads
+the source and yields (filename, author, title, publication_year) rows. When the registry is refreshed, a corpus is re-parsed only if the size or mtime
+of its source has changed since the last time it was compiled; otherwise its rows are left in the sqlite file untouched. Lookups are single-row
+queries against that file, so no corpus dictionary is ever held in memory.'''
+
+import os, sqlite3
+
+
+class MetadataRegistry(object):
+
+    '''An on-disk lookup of corpus metadata, compiled from the registered sources'''
+
+    def __init__(self, registry_path):
+        self.registry_path = registry_path
+        self.sources = {}
+        self.connection = None
+        self.connection_pid = None
+
+    def register_source(self, corpus, source_path, parser):
+        '''Register parser as the way to read the metadata for corpus out of source_path'''
+        self.sources[corpus] = (source_path, parser)
+
+    def connect(self):
+        '''Return a connection to the sqlite file. Worker processes forked from the indexer can't share their parent's connection, so each process opens its own'''
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.registry_path)
+
+            #the metadata files are read as byte-strings, and the indexer decodes the values itself, so keep them as byte-strings in sqlite too
+            self.connection.text_factory = str
+            self.connection_pid = os.getpid()
+
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sources (corpus TEXT PRIMARY KEY, source_path TEXT, size INTEGER, mtime REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (corpus TEXT, filename TEXT, author TEXT, title TEXT, publication_year TEXT, PRIMARY KEY (corpus, filename))")
+            self.connection.commit()
+        return self.connection
+
+    def source_is_current(self, corpus):
+        '''Return True if corpus was compiled from its source as that source currently stands on disk'''
+        source_path = self.sources[corpus][0]
+        source_stat = os.stat(source_path)
+        row = self.connect().execute("SELECT source_path, size, mtime FROM sources WHERE corpus = ?", (corpus,)).fetchone()
+        return row == (source_path, source_stat.st_size, source_stat.st_mtime)
+
+    def compile_source(self, corpus):
+        '''Parse the source for corpus and replace its rows in the sqlite file'''
+        source_path, parser = self.sources[corpus]
+        source_stat = os.stat(source_path)
+        connection = self.connect()
+
+        #the whole corpus is replaced in a single transaction, so an interrupted compile leaves the previous rows in place
+        with connection:
+            connection.execute("DELETE FROM metadata WHERE corpus = ?", (corpus,))
+
+            #like the dictionaries these rows replace, the first row seen for a filename wins
+            connection.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                ((corpus,) + tuple(row) for row in parser(source_path)))
+
+            connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)", (corpus, source_path, source_stat.st_size, source_stat.st_mtime))
+
+    def refresh(self):
+        '''Recompile each registered corpus whose source has changed. Returns the list of corpora that were recompiled.
+        A corpus whose source is missing keeps whatever rows it was last compiled with'''
+        recompiled_corpora = []
+        for corpus in sorted(self.sources):
+            if not os.path.exists(self.sources[corpus][0]):
+                continue
+            if not self.source_is_current(corpus):
+                self.compile_source(corpus)
+                recompiled_corpora.append(corpus)
+        return recompiled_corpora
+
+    def lookup(self, corpus, filename):
+        '''Return a dictionary containing the author, title, and publication_year of filename within corpus. Raises KeyError if there is no such row'''
+        row = self.connect().execute("SELECT author, title, publication_year FROM metadata WHERE corpus = ? AND filename = ?", (corpus, filename)).fetchone()
+        if row is None:
+            raise KeyError((corpus, filename))
+        return {"author": row[0], "title": row[1], "publication_year": row[2]}
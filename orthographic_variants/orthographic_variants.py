@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This module compiles the orthographic variants list (aggregate_variants.txt, one tab-separated group of equivalent spellings per row) into a compact
+binary index that can be memory-mapped, so that neither the search script nor any indexing-time normalization has to parse the list at startup.
+
+Each distinct group of spellings is interned under an integer group id. The compiled file holds, after a fixed header:
+
+    word_offsets  (number_of_words + 1) uint32 offsets into word_bytes, one per word in utf-8 byte order
+    word_groups   number_of_words uint32 group ids, the group each word belongs to
+    group_starts  (number_of_groups + 1) uint32 offsets into group_words
+    group_words   uint32 word ids, the members of each group in the order the variants list gives them
+    word_bytes    the utf-8 bytes of every word, concatenated
+
+A word is found by binary search over word_offsets, so a lookup touches a handful of pages of the mapped file and builds no dictionaries. As with the
+dictionary this replaces, a word that appears in more than one row belongs to the first row it appears in.
+
+Usage: python orthographic_variants.py aggregate_variants.txt aggregate_variants.idx'''
+
+import codecs, mmap, os, struct, sys
+
+header_format = "<8sIIIQd"
+header_size   = struct.calcsize(header_format)
+magic         = "OVIDX001"
+
+
+def read_variant_groups(variants_path):
+
+    '''generator that yields each row of the variants list as a list of stripped, non-empty unicode words'''
+
+    with codecs.open(variants_path, "r", "utf-8") as variants:
+        for row in variants:
+            group = [word.strip() for word in row.split("\t") if word.strip()]
+            if group:
+                yield group
+
+
+def compile_variant_index(variants_path, index_path):
+
+    '''compile the variants list at variants_path into the binary index at index_path'''
+
+    group_ids = {}
+    groups = []
+    word_group = {}
+
+    for group in read_variant_groups(variants_path):
+
+        #intern identical rows, so a group listed several times is stored once
+        group_key = tuple(group)
+        if group_key not in group_ids:
+            group_ids[group_key] = len(groups)
+            groups.append(group_key)
+
+        for word in group:
+            word_group.setdefault(word, group_ids[group_key])
+
+    #every member of every group needs a word id, even one that belongs to an earlier group
+    encoded_words = sorted( set( word.encode("utf-8") for group in groups for word in group ) )
+    word_ids = dict( (word, word_id) for word_id, word in enumerate(encoded_words) )
+
+    word_offsets = [0]
+    for word in encoded_words:
+        word_offsets.append(word_offsets[-1] + len(word))
+
+    group_starts = [0]
+    group_words = []
+    for group in groups:
+        group_words.extend( word_ids[word.encode("utf-8")] for word in group )
+        group_starts.append(len(group_words))
+
+    source_stat = os.stat(variants_path)
+
+    #write to a temporary file and rename it into place, so a reader never maps a half-written index
+    with open(index_path + ".tmp", "wb") as index_out:
+        index_out.write( struct.pack(header_format, magic, len(encoded_words), len(groups), len(group_words), source_stat.st_size, source_stat.st_mtime) )
+        index_out.write( struct.pack("<%dI" % len(word_offsets), *word_offsets) )
+        index_out.write( struct.pack("<%dI" % len(encoded_words), *[word_group[word.decode("utf-8")] for word in encoded_words]) )
+        index_out.write( struct.pack("<%dI" % len(group_starts), *group_starts) )
+        index_out.write( struct.pack("<%dI" % len(group_words), *group_words) )
+        index_out.write( "".join(encoded_words) )
+    os.rename(index_path + ".tmp", index_path)
+
+
+class VariantIndex(object):
+
+    '''a memory-mapped view of a compiled variant index'''
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as index_in:
+            self.mapped_index = mmap.mmap(index_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+        file_magic, self.number_of_words, self.number_of_groups, number_of_group_words, self.source_size, self.source_mtime = struct.unpack_from(header_format, self.mapped_index, 0)
+        if file_magic != magic:
+            raise ValueError("%s is not a compiled variant index" % index_path)
+
+        self.word_offsets_start = header_size
+        self.word_groups_start  = self.word_offsets_start + 4 * (self.number_of_words + 1)
+        self.group_starts_start = self.word_groups_start + 4 * self.number_of_words
+        self.group_words_start  = self.group_starts_start + 4 * (self.number_of_groups + 1)
+        self.word_bytes_start   = self.group_words_start + 4 * number_of_group_words
+
+    def read_uint32(self, section_start, i):
+        return struct.unpack_from("<I", self.mapped_index, section_start + 4 * i)[0]
+
+    def read_word(self, word_id):
+        start, end = struct.unpack_from("<II", self.mapped_index, self.word_offsets_start + 4 * word_id)
+        return self.mapped_index[self.word_bytes_start + start : self.word_bytes_start + end]
+
+    def find_word_id(self, encoded_word):
+        '''return the word id of the utf-8 encoded_word, or None if it isn't in any group'''
+        low, high = 0, self.number_of_words
+        while low < high:
+            middle = (low + high) // 2
+            if self.read_word(middle) < encoded_word:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.number_of_words and self.read_word(low) == encoded_word:
+            return low
+
+    def find_group_id(self, word):
+        '''return the group id of word, or None if it has no variants'''
+        word_id = self.find_word_id(word.encode("utf-8"))
+        if word_id is not None:
+            return self.read_uint32(self.word_groups_start, word_id)
+
+    def find_group_members(self, group_id):
+        '''return the members of group group_id as a list of unicode words'''
+        start, end = struct.unpack_from("<II", self.mapped_index, self.group_starts_start + 4 * group_id)
+        return [self.read_word(self.read_uint32(self.group_words_start, i)).decode("utf-8") for i in xrange(start, end)]
+
+    def find_variants(self, word):
+        '''return a list of all variants for word (including word itself), or None if it has no variants'''
+        group_id = self.find_group_id(word)
+        if group_id is not None:
+            return self.find_group_members(group_id)
+
+    def find_canonical_form(self, word):
+        '''return the first spelling listed in word's group, or word itself if it has no variants. This lets indexing-time normalization map every variant to one spelling'''
+        group_id = self.find_group_id(word)
+        if group_id is None:
+            return word
+        start = self.read_uint32(self.group_starts_start, group_id)
+        return self.read_word(self.read_uint32(self.group_words_start, start)).decode("utf-8")
+
+    def close(self):
+        self.mapped_index.close()
+
+
+def load_variant_index(variants_path, index_path):
+
+    '''return a VariantIndex for the variants list at variants_path, compiling it to index_path first if there is no compiled index yet or the list has changed since it was compiled'''
+
+    source_stat = os.stat(variants_path)
+    if os.path.isfile(index_path):
+        variant_index = VariantIndex(index_path)
+        if (variant_index.source_size, variant_index.source_mtime) == (source_stat.st_size, source_stat.st_mtime):
+            return variant_index
+        variant_index.close()
+
+    compile_variant_index(variants_path, index_path)
+    return VariantIndex(index_path)
+
+
+if __name__ == "__main__":
+    compile_variant_index(sys.argv[1], sys.argv[2])
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This script runs search_master_index.py as a long-running local service, so a short ad-hoc search doesn't pay for opening the index, building the
+punctuation table and loading the variant index, as every run of the search script (and every clone of it) does. The service keeps all of these warm,
+along with the query result cache, the text stores and the year and corpus filters, and searches with the parameters set in search_master_index.py.
+
+It speaks HTTP, on localhost or (if unix_socket_path is set) on a Unix socket:
+
+    GET  /status    the index generation being searched, the number of requests and windows served, the query cache counts, and, if instrumentation
+                    is turned on in search_master_index.py, everything it has recorded
+    POST /search    a json object holding any of:
+                        "windows"  a list of windows, each a list of words (or a string of them), e.g. [["the", "glory", "days"], "glory days and"]
+                        "terms"    a single free-form list of words to search as one window, of any length
+                        "text"     free text, searched as the rolling windows search_master_index.py would make of it
+
+A request that isn't a json object of that shape, or that has a window with no words left once it is tokenized (e.g. ["--"]), is answered with a 400
+before anything is searched. The response to a search is streamed as one json object per line, written as soon as each window has been verified: the
+window's number, words, matches (as outfile rows), and skipped queries, and the seconds it took. A window whose search fails gets an error in place of
+its matches, and the windows after it are still searched. A last line gives the number of windows searched and the total seconds.
+
+Requests are served one at a time, and each window is searched with the service's single warm searcher. A background thread checks every
+index_refresh_interval_seconds whether the index has been committed again or rebuilt, by comparing its generation and the ids of its segments (a
+rebuild starts counting generations again, but its segments are new). If it has, the thread opens a searcher over the new index while the old one
+keeps serving, and the new searcher takes over at the next window, along with new text stores. Cached results carry the generation and segment ids
+they were found with, so none from the old index are ever served for the new one.
+
+Usage: python query_service.py
+       curl -N localhost:8765/search -d '{"text": "the glory days and sweet love"}'
+       curl -N --unix-socket query_service.sock localhost/search -d '{"terms": ["glory", "days"]}' '''
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import UnixStreamServer
+from os import path
+import json, os, sys, threading, time
+
+#search_master_index.py and text_normalization.py live in sibling directories
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "search_master_index"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "text_normalization"))
+import search_master_index
+from text_normalization import load_punctuation_table, tokenize, tokenize_batch
+
+
+##############################
+# Specify Service Parameters #
+##############################
+
+#the service listens on service_port on localhost, or on unix_socket_path if it is set
+service_host                   = "127.0.0.1"
+service_port                   = 8765
+unix_socket_path               = None
+
+#how often the background thread checks whether the index has been committed again or rebuilt
+index_refresh_interval_seconds = 5
+
+
+#################
+# Query Service #
+#################
+
+class QueryService(object):
+
+    '''The warm searcher, query result cache and counts shared by every request, and the searcher waiting to replace the current one'''
+
+    def __init__(self):
+        self.searcher = None
+        self.index_generation = None
+        self.pending_searcher = None
+        self.pending_lock = threading.Lock()
+
+        self.query_result_cache = None
+        self.started = time.time()
+        self.requests_served = 0
+        self.windows_served = 0
+
+    def open(self):
+        '''Open the searcher and the query result cache, and build the punctuation table and load the variant index now, rather than on the first request'''
+        load_punctuation_table()
+        if search_master_index.variant_spelling_desired == 1:
+            search_master_index.find_orthographical_variants(u"the")
+
+        self.searcher, self.index_generation = search_master_index.open_searcher()
+        self.query_result_cache = search_master_index.create_query_result_cache()
+        print "searching index generation", self.index_generation
+
+    def refresh(self):
+        '''Open a searcher over the index if it has been committed again or rebuilt since the last searcher was opened, as told by its generation and the
+        ids of its segments. The new searcher waits in pending_searcher until the serving thread takes it up, so the old one keeps serving in the meantime'''
+        with self.pending_lock:
+            newest_generation = self.pending_searcher[1] if self.pending_searcher else self.index_generation
+        if search_master_index.find_index_generation() == newest_generation:
+            return
+
+        searcher, index_generation = search_master_index.open_searcher()
+        with self.pending_lock:
+            if self.pending_searcher is not None:
+                self.pending_searcher[0].close()
+            self.pending_searcher = (searcher, index_generation)
+
+    def take_up_pending_searcher(self):
+        '''Replace the searcher with the pending one, if there is one. Only the serving thread calls this, between windows'''
+        with self.pending_lock:
+            pending_searcher, self.pending_searcher = self.pending_searcher, None
+        if pending_searcher is None:
+            return
+
+        self.searcher.close()
+        self.searcher, self.index_generation = pending_searcher
+
+        #a rebuilt index has a new text store, which the stores opened for the old index can't read, and the filters of the old index will never be used again
+        for text_store in search_master_index.text_stores.values():
+            text_store.close()
+        search_master_index.text_stores.clear()
+        search_master_index.filter_bitsets.clear()
+        print "searching index generation", self.index_generation
+
+    def find_request_windows(self, search_request):
+        '''Return the windows a search request asks for, as a list of lists of words, in the order given. Every word is tokenized as the index's words
+        were, so a word given as "O'er" or "glory," is searched as the index holds it. Raises ValueError if the request isn't shaped as described above,
+        or if one of its windows has no words left once it is tokenized'''
+        if not isinstance(search_request, dict):
+            raise ValueError("the search request must be a json object")
+
+        request_windows = []
+        if not isinstance(search_request.get("windows", []), list):
+            raise ValueError('"windows" must be a list of windows')
+        for window_number, window in enumerate(search_request.get("windows", [])):
+            request_windows.append( tokenize_request_words(window, "window %d" % window_number) )
+
+        if search_request.get("terms") is not None:
+            request_windows.append( tokenize_request_words(search_request["terms"], '"terms"') )
+
+        if search_request.get("text") is not None:
+            if not isinstance(search_request["text"], basestring):
+                raise ValueError('"text" must be a string')
+            split_text = tokenize(search_request["text"])
+            if not split_text:
+                raise ValueError('"text" has no words once tokenized')
+            request_windows.extend( window_words for window_start, window_words in search_master_index.find_rolling_windows(split_text) )
+        return request_windows
+
+    def search(self, request_windows):
+        '''generator that searches each window in turn and yields its (matches, skips, error, seconds) as soon as it has been verified. A window whose
+        search fails yields the error, as a string, in place of its matches and skips, and the windows after it are still searched'''
+        self.requests_served += 1
+
+        #a deferred window would never be searched, so frequent windows are only left out if the search script would skip them outright
+        apply_cost_ceiling = search_master_index.frequent_window_policy != "defer"
+        for window_words in request_windows:
+            window_started = time.time()
+            self.windows_served += 1
+            try:
+                self.take_up_pending_searcher()
+                window_matches, window_skips = search_master_index.search_window(self.searcher, self.index_generation, self.query_result_cache, window_words, apply_cost_ceiling)
+            except Exception as e:
+                print "could not search window", window_words, ":", e
+                yield None, None, "%s: %s" % (type(e).__name__, e), time.time() - window_started
+                continue
+            yield window_matches, window_skips, None, time.time() - window_started
+
+        try:
+            self.query_result_cache.commit()
+        except Exception as e:
+            #the results have already been sent, so a cache that can't be written only costs later requests their cache hits
+            print "could not commit the query result cache:", e
+
+    def status(self):
+        '''Return a dictionary describing the service, for the status request'''
+        service_status = dict(index_generation=self.index_generation, uptime_seconds=time.time() - self.started, requests_served=self.requests_served,
+            windows_served=self.windows_served, query_cache=self.query_result_cache.report())
+        if search_master_index.instrumentation.enabled:
+            service_status["instrumentation"] = search_master_index.instrumentation.report()
+        return service_status
+
+    def close(self):
+        '''Close the searchers and the query result cache'''
+        self.take_up_pending_searcher()
+        self.searcher.close()
+        self.query_result_cache.close()
+
+
+def tokenize_request_words(words, request_field):
+
+    '''Return the tokens of the words given for one window of a search request, either a list of words or a string of them. request_field names
+    the window in the ValueError raised if it is neither, or if it has no words once tokenized'''
+
+    if isinstance(words, basestring):
+        window_words = tokenize(words)
+    elif isinstance(words, list) and all(isinstance(word, basestring) for word in words):
+        window_words = [token for word_tokens in tokenize_batch(words) for token in word_tokens]
+    else:
+        raise ValueError(request_field + " must be a list of words or a string of them")
+
+    if not window_words:
+        raise ValueError(request_field + " has no words once tokenized")
+    return window_words
+
+
+def refresh_searcher_periodically(query_service):
+
+    '''thread function: check for a newly committed index every index_refresh_interval_seconds, for as long as the service runs'''
+
+    while True:
+        time.sleep(index_refresh_interval_seconds)
+        try:
+            query_service.refresh()
+        except Exception as e:
+            #an index caught in the middle of being rebuilt can fail to open, so just try again next time
+            print "could not refresh the searcher:", e
+
+
+####################
+# Request Handling #
+####################
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+
+    '''Answers the status and search requests described above, with the query service the server was given'''
+
+    #responses are streamed until the connection closes, so they carry no content length
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        '''Log a request as BaseHTTPRequestHandler does, except that Unix socket clients, which have no address, are logged under the socket's path'''
+        client = self.client_address[0] if isinstance(self.client_address, tuple) else unix_socket_path
+        sys.stderr.write( "%s - - [%s] %s\n" % (client, self.log_date_time_string(), format % args) )
+
+    def send_json(self, status_code, response_object):
+        '''Send response_object as the whole, json-encoded response'''
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write( json.dumps(response_object) + "\n" )
+
+    def do_GET(self):
+        if self.path != "/status":
+            return self.send_json(404, dict(error="unknown path " + self.path))
+        self.send_json(200, self.server.query_service.status())
+
+    def do_POST(self):
+        if self.path != "/search":
+            return self.send_json(404, dict(error="unknown path " + self.path))
+
+        try:
+            search_request = json.loads( self.rfile.read(int(self.headers.getheader("Content-Length", 0))) )
+            request_windows = self.server.query_service.find_request_windows(search_request)
+        except (ValueError, TypeError, AttributeError) as e:
+            return self.send_json(400, dict(error="could not read the search request: " + str(e)))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        search_started = time.time()
+        for window_number, (window_matches, window_skips, window_error, window_seconds) in enumerate(self.server.query_service.search(request_windows)):
+            if window_error is not None:
+                window_result = dict(window=window_number, words=request_windows[window_number], error=window_error, seconds=window_seconds)
+            else:
+                window_result = dict(window=window_number, words=request_windows[window_number], matches=window_matches, seconds=window_seconds,
+                    skipped_queries=[dict(reason=reason, term_groups=term_groups, document_frequencies=group_frequencies) for reason, term_groups, group_frequencies in window_skips])
+            self.wfile.write( json.dumps(window_result) + "\n" )
+            self.wfile.flush()
+
+        self.wfile.write( json.dumps(dict(done=True, windows=len(request_windows), seconds=time.time() - search_started)) + "\n" )
+
+
+class QueryHTTPServer(HTTPServer):
+
+    '''An HTTP server on localhost that hands each request the query service'''
+
+    def __init__(self, server_address, query_service):
+        HTTPServer.__init__(self, server_address, QueryRequestHandler)
+        self.query_service = query_service
+
+
+class QueryUnixServer(UnixStreamServer):
+
+    '''An HTTP server on a Unix socket that hands each request the query service'''
+
+    def __init__(self, socket_path, query_service):
+        if path.exists(socket_path):
+            os.remove(socket_path)
+        UnixStreamServer.__init__(self, socket_path, QueryRequestHandler)
+        self.query_service = query_service
+
+
+if __name__ == "__main__":
+
+    query_service = QueryService()
+    query_service.open()
+
+    refresh_thread = threading.Thread(target=refresh_searcher_periodically, args=(query_service,))
+    refresh_thread.daemon = True
+    refresh_thread.start()
+
+    if unix_socket_path:
+        server = QueryUnixServer(unix_socket_path, query_service)
+        print "serving on", unix_socket_path
+    else:
+        server = QueryHTTPServer((service_host, service_port), query_service)
+        print "serving on http://%s:%d" % (service_host, service_port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        query_service.close()
+        if unix_socket_path and path.exists(unix_socket_path):
+            os.remove(unix_socket_path)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This module instruments the index and search scripts, so a run can tell where its time went: metadata, decoding, analysis, span queries,
+verification, and so on.
+
+A RunInstrumentation accumulates, for the run as a whole:
+
+    stages      the total seconds spent in, and number of entries into, each named stage
+    counters    named totals, e.g. files, bytes, windows, queries, hits, and verified matches
+    latencies   for each kind of item (e.g. window or file), a histogram of the seconds each item took and the slowest items seen
+
+Worker processes each keep their own, and hand the parent what they have accumulated with take_snapshot(), which the parent folds into its own with
+add_snapshot(). At the end of a run write_report() writes everything as json. When instrumentation is turned off every method returns at once, so the
+calls can stay in the scripts' inner loops.'''
+
+from contextlib import contextmanager
+import heapq, json, sys, time
+
+#the upper bounds, in milliseconds, of the latency histogram buckets. A last bucket holds everything slower
+histogram_bucket_bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+
+class RunInstrumentation(object):
+
+    '''Per-stage timers, counters, latency histograms, and slowest items for one run'''
+
+    def __init__(self, enabled=True, progress_line_desired=False, slowest_item_count=20):
+        self.enabled = enabled
+        self.progress_line_desired = progress_line_desired
+        self.slowest_item_count = slowest_item_count
+        self.started = time.time()
+        self.last_progress = 0.0
+        self.reset()
+
+    def reset(self):
+        '''Discard everything accumulated so far. A forked worker process calls this as it starts, so its snapshots hold only what it recorded itself'''
+        self.stage_seconds = {}
+        self.stage_entries = {}
+        self.counters = {}
+        self.histograms = {}
+        self.slowest_items = {}
+
+    @contextmanager
+    def stage(self, stage_name):
+        '''Context manager that adds the time spent inside it to stage_name'''
+        if not self.enabled:
+            yield
+            return
+        stage_started = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage_name, time.time() - stage_started)
+
+    def add_stage_time(self, stage_name, seconds, entries=1):
+        '''Add seconds (over entries entries) to the time spent in stage_name'''
+        if self.enabled:
+            self.stage_seconds[stage_name] = self.stage_seconds.get(stage_name, 0.0) + seconds
+            self.stage_entries[stage_name] = self.stage_entries.get(stage_name, 0) + entries
+
+    def count(self, counter_name, amount=1):
+        '''Add amount to counter_name'''
+        if self.enabled:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+    def record_latency(self, item_kind, item, seconds):
+        '''Record that item (e.g. a window, or a file) of item_kind took seconds, in item_kind's histogram and, if it is slow enough, its slowest items'''
+        if not self.enabled:
+            return
+
+        histogram = self.histograms.setdefault(item_kind, [0] * (len(histogram_bucket_bounds) + 1))
+        milliseconds = seconds * 1000.0
+        bucket = 0
+        while bucket < len(histogram_bucket_bounds) and milliseconds > histogram_bucket_bounds[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+
+        self.offer_slowest_item(item_kind, item, seconds)
+
+    def offer_slowest_item(self, item_kind, item, seconds):
+        '''Keep item among item_kind's slowest items if it is slower than the fastest of them'''
+        #the slowest items are kept in a min-heap, so the fastest of them is the one replaced
+        slowest_items = self.slowest_items.setdefault(item_kind, [])
+        if len(slowest_items) < self.slowest_item_count:
+            heapq.heappush(slowest_items, (seconds, item))
+        elif seconds > slowest_items[0][0]:
+            heapq.heapreplace(slowest_items, (seconds, item))
+
+    def take_snapshot(self):
+        '''Return everything accumulated so far as a plain dictionary (which can be passed between processes), and start accumulating afresh'''
+        snapshot = {"stage_seconds": self.stage_seconds, "stage_entries": self.stage_entries, "counters": self.counters,
+                    "histograms": self.histograms, "slowest_items": self.slowest_items}
+        self.reset()
+        return snapshot
+
+    def add_snapshot(self, snapshot):
+        '''Fold a snapshot taken by another instrumentation (e.g. a worker process's) into this one'''
+        if not self.enabled or snapshot is None:
+            return
+        for stage_name in snapshot["stage_seconds"]:
+            self.add_stage_time(stage_name, snapshot["stage_seconds"][stage_name], snapshot["stage_entries"][stage_name])
+        for counter_name, amount in snapshot["counters"].items():
+            self.count(counter_name, amount)
+        for item_kind, histogram in snapshot["histograms"].items():
+            own_histogram = self.histograms.setdefault(item_kind, [0] * (len(histogram_bucket_bounds) + 1))
+            for bucket, bucket_count in enumerate(histogram):
+                own_histogram[bucket] += bucket_count
+        for item_kind, slowest_items in snapshot["slowest_items"].items():
+            for seconds, item in slowest_items:
+                self.offer_slowest_item(item_kind, item, seconds)
+
+    def show_progress(self, done, total, label):
+        '''Rewrite the live progress line on stderr, at most once a second, with done out of total label and the rate so far'''
+        if not self.progress_line_desired:
+            return
+        now = time.time()
+        if now - self.last_progress < 1.0 and done < total:
+            return
+        self.last_progress = now
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = (total - done) / rate if rate > 0 else 0.0
+        sys.stderr.write("\r%d/%d %s (%.1f%%), %.1f per second, %ds elapsed, about %ds to go " % (done, total, label, 100.0 * done / max(total, 1), rate, elapsed, remaining))
+        if done >= total:
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+
+    def report(self):
+        '''Return everything accumulated as a dictionary ready to be written as json'''
+        histogram_labels = ["<=%dms" % bound for bound in histogram_bucket_bounds] + [">%dms" % histogram_bucket_bounds[-1]]
+        return {
+            "wall_seconds": time.time() - self.started,
+            "stages": dict( (stage_name, {"seconds": self.stage_seconds[stage_name], "entries": self.stage_entries[stage_name]}) for stage_name in self.stage_seconds ),
+            "counters": self.counters,
+            "latency_histograms": dict( (item_kind, dict(zip(histogram_labels, histogram))) for item_kind, histogram in self.histograms.items() ),
+            "slowest_items": dict( (item_kind, [{"item": item, "seconds": seconds} for seconds, item in sorted(slowest_items, reverse=True)]) for item_kind, slowest_items in self.slowest_items.items() ),
+        }
+
+    def write_report(self, report_path):
+        '''Write the report to report_path as json, and print the stages from slowest to fastest'''
+        if not self.enabled:
+            return
+        report = self.report()
+        with open(report_path, "w") as report_out:
+            json.dump(report, report_out, indent=2, sort_keys=True)
+
+        print "instrumentation report written to", report_path
+        for stage_name in sorted(report["stages"], key=lambda stage_name: -report["stages"][stage_name]["seconds"]):
+            print "    %-24s %10.3fs over %d entries" % (stage_name, report["stages"][stage_name]["seconds"], report["stages"][stage_name]["entries"])
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This module lets search_master_index.py prove, before it builds a span query, that the words of a query (each with its variants) never occur in
+the same document, so the query can't match and can be skipped.
+
+The prefilter is built from the index for a fixed vocabulary, the words of the input text and their variants. A word is frequent if it occurs in at
+least frequent_document_fraction of the documents:
+
+    frequent words  each keeps a zlib-compressed bitmap of the documents it occurs in. Bitmaps are decompressed into python integers as they are
+                    needed, so intersecting two of them is a single bitwise and
+    rarer words     every pair of them that occurs together in some document goes into a Bloom filter. A pair missing from the filter certainly
+                    never shares a document, without a single read from the index
+
+A query passes the prefilter unless two groups of rarer words have no pair in the Bloom filter, the bitmaps of the frequent groups have no document
+in common, or the documents of the rarer groups (read from their postings, which are short by definition) are not among those the frequent groups
+share. The test never rejects a query that has a document containing all of its groups, so skipping a rejected query never loses a match.'''
+
+from collections import OrderedDict
+from whoosh.reading import TermNotFound
+import binascii, hashlib, marshal, math, os, struct, zlib
+
+
+def find_document_ids(searcher, term, fieldname="content"):
+
+    '''Return the sorted list of the documents that term occurs in'''
+
+    try:
+        return list(searcher.postings(fieldname, term).all_ids())
+    except TermNotFound:
+        return []
+
+
+def integer_from_document_ids(document_ids):
+
+    '''Return a bitmap of document_ids as a python integer, in which bit n is set if document n is in document_ids'''
+
+    if not document_ids:
+        return 0
+    bitmap = bytearray(max(document_ids) // 8 + 1)
+    for document_id in document_ids:
+        bitmap[document_id >> 3] |= 1 << (document_id & 7)
+    return integer_from_bitmap(bitmap)
+
+
+def integer_from_bitmap(bitmap):
+
+    '''Return the little-endian bitmap (byte 0 holds documents 0 to 7) as a python integer'''
+
+    return int(binascii.hexlify(bytes(bitmap[::-1])), 16) if bitmap else 0
+
+
+class CooccurrencePrefilter(object):
+
+    '''Compressed document bitmaps for frequent words and a Bloom filter over the pairs of rarer words that share a document'''
+
+    def __init__(self, frequent_document_fraction=0.05, false_positive_rate=0.01, maximum_pairs=50000000, cached_bitmaps=1024):
+        self.frequent_document_fraction = frequent_document_fraction
+        self.false_positive_rate = false_positive_rate
+        self.maximum_pairs = maximum_pairs
+        self.cached_bitmaps = cached_bitmaps
+
+        self.terms = set()
+        self.frequent_bitmaps = {}
+        self.bloom_bits = None
+        self.bloom_size = 0
+        self.bloom_hashes = 0
+        self.decompressed_bitmaps = OrderedDict()
+
+        self.checked = 0
+        self.skipped = 0
+
+    def build(self, searcher, terms, fieldname="content"):
+        '''Read the documents of each of terms from the searcher's postings, and build the bitmaps and the Bloom filter'''
+        self.terms = set(terms)
+        frequent_document_frequency = max(1, int(math.ceil(searcher.doc_count_all() * self.frequent_document_fraction)))
+
+        rare_terms_by_document = {}
+        for term in sorted(self.terms):
+            document_ids = find_document_ids(searcher, term, fieldname)
+            if len(document_ids) >= frequent_document_frequency:
+                bitmap = bytearray(document_ids[-1] // 8 + 1)
+                for document_id in document_ids:
+                    bitmap[document_id >> 3] |= 1 << (document_id & 7)
+                self.frequent_bitmaps[term] = zlib.compress(bytes(bitmap))
+            else:
+                for document_id in document_ids:
+                    rare_terms_by_document.setdefault(document_id, []).append(term)
+
+        #the filter is sized for every pair it might hold. If that is more than maximum_pairs, there is no filter, and rarer words are only ever checked against their postings
+        number_of_pairs = sum( len(document_terms) * (len(document_terms) - 1) // 2 for document_terms in rare_terms_by_document.values() )
+        if 0 < number_of_pairs <= self.maximum_pairs:
+            self.bloom_size = int(math.ceil(-number_of_pairs * math.log(self.false_positive_rate) / math.log(2) ** 2))
+            self.bloom_hashes = max(1, int(round(float(self.bloom_size) / number_of_pairs * math.log(2))))
+            self.bloom_bits = bytearray(self.bloom_size // 8 + 1)
+            for document_terms in rare_terms_by_document.values():
+                for i in xrange(len(document_terms)):
+                    for j in xrange(i + 1, len(document_terms)):
+                        for bit in self.find_pair_bits(document_terms[i], document_terms[j]):
+                            self.bloom_bits[bit >> 3] |= 1 << (bit & 7)
+
+    def find_pair_bits(self, first_term, second_term):
+        '''Return the Bloom filter bits for the pair of terms, whichever order they are given in'''
+        if second_term < first_term:
+            first_term, second_term = second_term, first_term
+        first_hash, second_hash = struct.unpack("<QQ", hashlib.md5((first_term + u"\t" + second_term).encode("utf-8")).digest())
+        return [(first_hash + k * second_hash) % self.bloom_size for k in xrange(self.bloom_hashes)]
+
+    def pair_may_cooccur(self, first_term, second_term):
+        '''Return False if the two rarer terms certainly never share a document'''
+        return all( self.bloom_bits[bit >> 3] & (1 << (bit & 7)) for bit in self.find_pair_bits(first_term, second_term) )
+
+    def find_frequent_bitmap(self, term):
+        '''Return the documents of the frequent term as a python integer, decompressing its bitmap if it isn't among the most recently used'''
+        bitmap = self.decompressed_bitmaps.pop(term, None)
+        if bitmap is None:
+            bitmap = integer_from_bitmap(bytearray(zlib.decompress(self.frequent_bitmaps[term])))
+        self.decompressed_bitmaps[term] = bitmap
+        if len(self.decompressed_bitmaps) > self.cached_bitmaps:
+            self.decompressed_bitmaps.popitem(last=False)
+        return bitmap
+
+    def may_cooccur(self, searcher, term_groups, fieldname="content"):
+        '''Return False if no document holds a term from every one of term_groups, and True if one may. Terms outside the prefilter's vocabulary always pass'''
+        self.checked += 1
+        if self.test_groups(searcher, term_groups, fieldname):
+            return True
+        self.skipped += 1
+        return False
+
+    def test_groups(self, searcher, term_groups, fieldname):
+        '''Test term_groups against the Bloom filter, then the frequent bitmaps, then the postings of the rarer groups, cheapest first'''
+        if not all( term in self.terms for group in term_groups for term in group ):
+            return True
+
+        frequent_groups = [group for group in term_groups if any( term in self.frequent_bitmaps for term in group )]
+        rare_groups = [group for group in term_groups if group not in frequent_groups]
+
+        #two groups that share a term share every document that term is in, so only groups with no term in common are looked up as pairs
+        if self.bloom_bits is not None:
+            for i in xrange(len(rare_groups)):
+                for j in xrange(i + 1, len(rare_groups)):
+                    if not set(rare_groups[i]) & set(rare_groups[j]):
+                        if not any( self.pair_may_cooccur(first_term, second_term) for first_term in rare_groups[i] for second_term in rare_groups[j] ):
+                            return False
+
+        #a frequent group's documents are the union of its terms' documents, including any of its terms that are rarer
+        shared_documents = None
+        for group in frequent_groups:
+            group_documents = 0
+            for term in group:
+                if term in self.frequent_bitmaps:
+                    group_documents |= self.find_frequent_bitmap(term)
+                else:
+                    group_documents |= integer_from_document_ids(find_document_ids(searcher, term, fieldname))
+            shared_documents = group_documents if shared_documents is None else shared_documents & group_documents
+            if not shared_documents:
+                return False
+
+        if not rare_groups:
+            return True
+
+        rare_documents = None
+        for group in rare_groups:
+            group_documents = set( document_id for term in group for document_id in find_document_ids(searcher, term, fieldname) )
+            rare_documents = group_documents if rare_documents is None else rare_documents & group_documents
+            if not rare_documents:
+                return False
+
+        return shared_documents is None or any( (shared_documents >> document_id) & 1 for document_id in rare_documents )
+
+    def load(self, prefilter_path, prefilter_key):
+        '''Read the prefilter saved at prefilter_path, and return True, if it was saved under prefilter_key. Otherwise return False'''
+        try:
+            with open(prefilter_path, "rb") as prefilter_in:
+                saved_prefilter = marshal.load(prefilter_in)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if saved_prefilter.get("key") != prefilter_key:
+            return False
+
+        self.terms = set(saved_prefilter["terms"])
+        self.frequent_bitmaps = saved_prefilter["frequent_bitmaps"]
+        self.bloom_bits = bytearray(saved_prefilter["bloom_bits"]) if saved_prefilter["bloom_bits"] is not None else None
+        self.bloom_size = saved_prefilter["bloom_size"]
+        self.bloom_hashes = saved_prefilter["bloom_hashes"]
+        return True
+
+    def save(self, prefilter_path, prefilter_key):
+        '''Write the prefilter to prefilter_path under prefilter_key, atomically. If the path isn't writable, the prefilter is simply not saved'''
+        saved_prefilter = dict(key=prefilter_key, terms=list(self.terms), frequent_bitmaps=self.frequent_bitmaps, bloom_size=self.bloom_size,
+            bloom_hashes=self.bloom_hashes, bloom_bits=bytes(self.bloom_bits) if self.bloom_bits is not None else None)
+        try:
+            with open(prefilter_path + ".tmp", "wb") as prefilter_out:
+                marshal.dump(saved_prefilter, prefilter_out)
+            os.rename(prefilter_path + ".tmp", prefilter_path)
+        except (IOError, OSError):
+            pass
+
+    def counts(self):
+        '''Return the (queries checked, queries skipped) counts'''
+        return (self.checked, self.skipped)
+
+    def add_counts(self, counts):
+        '''Add the counts reported by another prefilter (e.g. a worker process's) to these, so report covers the whole run'''
+        self.checked += counts[0]
+        self.skipped += counts[1]
+
+    def report(self):
+        '''Return a one-line summary of the queries checked and skipped'''
+        skip_rate = 100.0 * self.skipped / self.checked if self.checked else 0.0
+        return "co-occurrence prefilter: %d frequent words, %d-bit pair filter, skipped %d of %d queries (%.1f%% skip rate)" % (len(self.frequent_bitmaps),
+            self.bloom_size, self.skipped, self.checked, skip_rate)
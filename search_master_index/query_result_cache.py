@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This module memoizes the verified matches for each query that search_master_index.py runs. A query is keyed on its search terms and every search
+parameter that can change its matches, so a word sequence that recurs across the rolling windows of the input text (or across re-runs with the same
+parameters) is answered without touching the index.
+
+Matches are held in a bounded LRU dictionary in memory. If a persistent path is given, every result is also written through to an sqlite file, which
+is consulted whenever the memory tier misses.'''
+
+from collections import OrderedDict
+import json, sqlite3
+
+
+class QueryResultCache(object):
+
+    '''A bounded LRU cache of query results, optionally backed by an sqlite file'''
+
+    def __init__(self, maximum_entries, persistent_path=None, persistent_commit_interval=1000):
+        self.maximum_entries = maximum_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        self.persistent_commit_interval = persistent_commit_interval
+        self.uncommitted_writes = 0
+        if persistent_path:
+            #parallel searches share the persistent file between worker processes, so wait for each other's writes rather than failing
+            self.connection = sqlite3.connect(persistent_path, timeout=60)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS query_results (query_key TEXT PRIMARY KEY, matches TEXT)")
+            self.connection.commit()
+
+    def remember(self, key, matches):
+        '''Store matches in the memory tier, evicting the least recently used entry if the tier is full'''
+        self.entries.pop(key, None)
+        self.entries[key] = matches
+        if len(self.entries) > self.maximum_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        '''Return the cached matches for key, or None if neither tier holds them'''
+        if key in self.entries:
+            self.hits += 1
+            matches = self.entries.pop(key)
+            self.entries[key] = matches
+            return matches
+
+        if self.connection is not None:
+            row = self.connection.execute("SELECT matches FROM query_results WHERE query_key = ?", (json.dumps(key),)).fetchone()
+            if row is not None:
+                self.persistent_hits += 1
+                matches = json.loads(row[0])
+                self.remember(key, matches)
+                return matches
+
+        self.misses += 1
+        return None
+
+    def put(self, key, matches):
+        '''Cache matches under key in memory and, if there is one, in the persistent tier'''
+        self.remember(key, matches)
+
+        if self.connection is not None:
+            self.connection.execute("INSERT OR REPLACE INTO query_results VALUES (?, ?)", (json.dumps(key), json.dumps(matches)))
+            self.uncommitted_writes += 1
+            if self.uncommitted_writes >= self.persistent_commit_interval:
+                self.connection.commit()
+                self.uncommitted_writes = 0
+
+    def commit(self):
+        '''Commit any outstanding writes to the persistent tier'''
+        if self.connection is not None:
+            self.connection.commit()
+            self.uncommitted_writes = 0
+
+    def close(self):
+        '''Commit any outstanding writes and close the persistent tier'''
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
+            self.connection = None
+
+    def counts(self):
+        '''Return the (memory hits, persistent hits, misses) counts'''
+        return (self.hits, self.persistent_hits, self.misses)
+
+    def add_counts(self, counts):
+        '''Add the counts reported by another cache (e.g. a worker process's) to these, so report covers the whole run'''
+        self.hits            += counts[0]
+        self.persistent_hits += counts[1]
+        self.misses          += counts[2]
+
+    def report(self):
+        '''Return a one-line summary of the cache hits and misses'''
+        lookups = self.hits + self.persistent_hits + self.misses
+        hit_rate = 100.0 * (self.hits + self.persistent_hits) / lookups if lookups else 0.0
+        return "query cache: %d memory hits, %d persistent hits, %d misses (%.1f%% hit rate)" % (self.hits, self.persistent_hits, self.misses, hit_rate)
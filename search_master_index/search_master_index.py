@@ -4,41 +4,52 @@
 from whoosh.index import create_in
 from whoosh.fields import Schema, TEXT, ID, analysis
 from whoosh.qparser import QueryParser, SequencePlugin, PhrasePlugin
-from whoosh.query import spans, Term
-from whoosh.index import open_dir
-from os import path, mkdir
+from whoosh.query import spans, NumericRange, Term
+from whoosh.index import exists_in, open_dir, TOC
+from whoosh.reading import MultiReader, TermNotFound
+from whoosh.searching import Searcher
+from whoosh.idsets import BitSet
+from os import listdir, path, mkdir
 from string import maketrans, punctuation
-from sys import maxunicode
-from nltk import clean_html
-import string, itertools, codecs, unicodedata, numpy
+from collections import OrderedDict
+import string, itertools, codecs, hashlib, heapq, math, multiprocessing, sys, time
 
-
-#################### 
-# Load Punctuation #
-####################
-
-#load unicode punctuation
-tbl = dict.fromkeys(i for i in xrange(maxunicode)
-                      if unicodedata.category(unichr(i)).startswith('P'))
-
-#create function with which to strip punct from unicode
-def remove_punctuation(unicode_text):
-    return unicode_text.translate(tbl)
+#query_result_cache.py and cooccurrence_prefilter.py live alongside this script, and orthographic_variants.py, text_normalization.py, text_store.py and run_instrumentation.py in sibling directories
+sys.path.append(path.dirname(path.abspath(__file__)))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "orthographic_variants"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "text_normalization"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "text_store"))
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "run_instrumentation"))
+from query_result_cache import QueryResultCache
+from cooccurrence_prefilter import CooccurrencePrefilter
+from run_instrumentation import RunInstrumentation
+from orthographic_variants import load_variant_index
+from text_normalization import remove_punctuation, tokenize
+from text_store import TextStore
 
 
 ##############
 # Load Input #
 ##############
 
-with codecs.open("/afs/crc.nd.edu/user/d/dduhaime/data/hill/hill_poetic_corpus.txt","r","utf-8") as raw_input_text:
-    clean_input_text = remove_punctuation( raw_input_text.read() )
-    split_input_text = clean_input_text.lower().split()
+def load_input_text():
+
+    '''Read the input text and return it as a list of words, tokenized exactly as the index tokenizes its content'''
+
+    with codecs.open(input_text_path,"r","utf-8") as raw_input_text:
+        split_input_text = tokenize( raw_input_text.read() )
+    return split_input_text
 
 
 #############################
 # Specify Search Parameters #
 #############################
 
+input_text_path                  = "/afs/crc.nd.edu/user/d/dduhaime/data/hill/hill_poetic_corpus.txt"
+index_directory                  = "/afs/crc.nd.edu/user/d/dduhaime/code/create_whoosh_index/index"
+variants_path                    = "/afs/crc.nd.edu/user/d/dduhaime/data/orthographic_variants/aggregate_variants.txt"
+compiled_variants_path           = "aggregate_variants.idx"
+
 maximum_number_of_hits_per_query = 5
 proximity_value                  = 8
 window_length                    = 3
@@ -48,20 +59,96 @@ variant_spelling_desired         = 0
 proximity_search_desired         = 1
 exact_search_desired             = 0
 
+#set postings_verification_desired to 1 to verify hits with the term positions stored in the index rather than by re-reading and re-highlighting each file. This requires an index whose content field records characters (see create_master_index.py)
+#it is also the only verification that can search an index built as passages (see passage_indexing_desired in create_master_index.py), placing each passage hit back in its text
+postings_verification_desired    = 1
+snippet_context_characters       = 200
+
+#indices that don't store their content keep it in a text store in this subdirectory of the index (or of each shard), as create_master_index.py names it
+text_store_directory_name        = "text_store"
+
+#set shingle_search_desired to 1 to find exact matches through the content_shingles field, which create_master_index.py writes when shingle_field_desired is set. shingle_size must match the size the index was built with, and windows shorter than it fall back to verifying span hits
+shingle_search_desired           = 0
+shingle_size                     = 3
+
+#set top_k_desired to 1 to stop verifying the hits for a query once maximum_number_of_hits_per_query matches are found. The hits are verified in the order
+#given by top_k_ranking: "index order" (no scoring at all), "score" (BM25), or "publication year" (earliest first). Top-k mode requires postings verification
+top_k_desired                    = 0
+top_k_ranking                    = "index order"
+
+#set sharded_index_desired to 1 to search an index that create_master_index.py wrote as one shard per corpus. searched_shards lists the corpora to search
+#(e.g. ["ecco", "eebo"]), and None searches every shard in index_directory
+sharded_index_desired            = 0
+searched_shards                  = None
+
+#set searched_year_ranges to a list of inclusive (start year, end year) pairs, e.g. [(1650, 1699)], and/or searched_corpora to a list of corpus names, e.g. ["ecco"], to
+#search only the texts within them. Both need an index with the year and corpus fields. Each range is split into blocks of year_filter_granularity years, and
+#the documents in each block are collected into a bitset once and reused, so ranges built from the same decades (or centuries) share their bitsets
+searched_year_ranges             = None
+searched_corpora                 = None
+year_filter_granularity          = 10
+
+#the query planner reads each word's document frequency before a window is searched, and drops queries containing a word that is in no document.
+#If maximum_planned_document_frequency is set, a window whose words all appear in more documents than that is either skipped or (with frequent_window_policy = "defer") searched after every other window.
+#Skipped queries are listed in a _skipped_queries.txt file next to the outfile
+query_planner_desired              = 1
+maximum_planned_document_frequency = None
+frequent_window_policy             = "defer"
+
+#set cooccurrence_prefilter_desired to 1 to skip, before any span query is built, every query whose words (with their variants) never occur in the same document.
+#The prefilter is built from the index for the words of the input text: a compressed bitmap of the documents of each word found in at least
+#prefilter_frequent_document_fraction of the documents, and a Bloom filter over the pairs of rarer words that share a document. It is saved to
+#cooccurrence_prefilter_path and only rebuilt when the index or the input text changes. Skipped queries are listed with the planner's, and the skip rate is printed
+cooccurrence_prefilter_desired       = 0
+prefilter_frequent_document_fraction = 0.05
+prefilter_false_positive_rate        = 0.01
+cooccurrence_prefilter_path          = "cooccurrence_prefilter.marshal"
+
+#set parameter_sweep_desired to 1 to search for every combination of swept_proximity_values and swept_window_lengths in a single pass, instead of rerunning the
+#search once per combination. Each window is queried once, with the shortest swept window length at the largest swept proximity value, the span of every
+#verified match is measured for each window length, and each match is written to the outfile of every combination it satisfies. A sweep needs postings
+#verification, and searches its windows serially, without the query cache, without deferring frequent windows, and without the top-k cutoff
+parameter_sweep_desired          = 0
+swept_proximity_values           = [4, 8, 16]
+swept_window_lengths             = [2, 3, 4]
+
+#set instrumentation_desired to 1 to time each stage of the search (variant lookup, plan, cache lookup, span query, verify, snippets, highlight and verify,
+#shingle query), count the windows, queries, hits, and verified matches, keep a histogram of the time each window took along with the slowest windows, and
+#write all of it to an _instrumentation.json file next to the outfile. Set progress_line_desired to 1 for a live progress line on stderr
+instrumentation_desired          = 0
+progress_line_desired            = 0
+instrumentation                  = RunInstrumentation(instrumentation_desired == 1, progress_line_desired == 1)
+
+#the matches for each query are memoized in an LRU cache of query_cache_size entries. Set persistent_query_cache_desired to 1 to keep them on disk as well, so re-runs with the same parameters reuse them
+query_cache_size                 = 100000
+persistent_query_cache_desired   = 0
+persistent_query_cache_path      = "query_result_cache.sqlite"
+
+#set parallel_search_desired to 1 to split the rolling windows into contiguous shares across a pool of worker processes. Each worker keeps one searcher open for the whole run, and the matches are written in input order, so the outfile matches a serial run
+parallel_search_desired          = 0
+number_of_worker_processes       = multiprocessing.cpu_count()
+window_shares_per_worker_process = 16
+
     
 ##################
 # Create Outfile #
 ##################
 
-def find_outfile_name():
+def find_outfile_name(outfile_proximity_value=None, outfile_window_length=None):
 
-    '''Get an unused outfile name so we don't write over extant outfiles. Write search parameters into outfile name'''
+    '''Get an unused outfile name so we don't write over extant outfiles. Write search parameters into outfile name. A parameter sweep names each of its
+    outfiles for the proximity value and window length it holds, rather than the ones set below'''
+
+    if outfile_proximity_value is None:
+        outfile_proximity_value = proximity_value
+    if outfile_window_length is None:
+        outfile_window_length = window_length
 
     outfile_integer = 0
-    outfile_name    = "hill_search_results_" + str(variant_spelling_desired) + str(maximum_number_of_hits_per_query) + str(proximity_value) + str(window_length) + str(window_slide_interval) + "_" + str(outfile_integer) + ".txt"
+    outfile_name    = "hill_search_results_" + str(variant_spelling_desired) + str(maximum_number_of_hits_per_query) + str(outfile_proximity_value) + str(outfile_window_length) + str(window_slide_interval) + "_" + str(outfile_integer) + ".txt"
     while path.isfile( outfile_name ):
         outfile_integer += 1
-        outfile_name = "hill_search_results_" + str(variant_spelling_desired) + str(maximum_number_of_hits_per_query) + str(proximity_value) + str(window_length) + str(window_slide_interval) + "_" + str(outfile_integer) + ".txt"
+        outfile_name = "hill_search_results_" + str(variant_spelling_desired) + str(maximum_number_of_hits_per_query) + str(outfile_proximity_value) + str(outfile_window_length) + str(window_slide_interval) + "_" + str(outfile_integer) + ".txt"
     return outfile_name
     
 
@@ -69,26 +156,15 @@ def find_outfile_name():
 # Prepare Orthographical Variants #
 ###################################
 
-#load orthographic equivalents once as a list or set that you can ping hereafter. The most efficient data structure for this list is likely a dictionary that contains as its various keys the words from the input text, and contains as its values the variants associated with those keys
-if variant_spelling_desired == 1:
-    with codecs.open("/afs/crc.nd.edu/user/d/dduhaime/data/orthographic_variants/aggregate_variants.txt","r","utf-8") as variants:
-        variants_dictionary = {}
-        variants = variants.read().split("\n")
-        for i in variants:
-            s_i = i.split("\t")
-        
-            #we now have a list containing each word in the current row. Alas, we need to make each of the members of this list a key in the dict, and must load all words in the row into the values for that key:
-            for j in s_i:
-            
-                new_dict_key = j.strip()
-                if new_dict_key not in variants_dictionary.keys():
-                    variants_dictionary[new_dict_key] = u" ".join(j.strip() for j in s_i)
+#the variants list is compiled once into a memory-mapped index (see orthographic_variants.py), which is opened the first time a variant is looked up
+variant_index = None
 
-    def find_orthographical_variants(word):
-        '''this function reads in a word and, after parsing our variants_dictionary, returns a list of all variants for that word'''
-        word = word.strip()
-        if word in variants_dictionary.keys():
-            return variants_dictionary[word].split()
+def find_orthographical_variants(word):
+    '''this function reads in a word and returns a list of all variants for that word, or None if it has none'''
+    global variant_index
+    if variant_index is None:
+        variant_index = load_variant_index(variants_path, compiled_variants_path)
+    return variant_index.find_variants(word.strip())
 
 ################################ 
 # Exhaustive Exact Match Check #
@@ -105,22 +181,145 @@ def check_for_path_through_indices(l):
     
     return bool(reduce(recursive_exact_match, l))
 
+def find_exact_match_window(l):
+    '''this function reads in the same list of lists as check_for_path_through_indices and returns the first exact match as a (span, first position, last position) tuple, or None'''
+    end_positions = reduce(recursive_exact_match, l)
+    if end_positions:
+        last_position = min(end_positions)
+        return (len(l) - 1, last_position - len(l) + 1, last_position)
+
     
 ##############################
 # Exhaustive Proximity Check #
 ##############################
 
+def find_minimum_covering_window(A):
+
+    '''this function reads in a list of sorted sublists of index positions, one sublist per search term, and returns the shortest window that contains
+    a distinct position from every sublist as a (span, first position, last position) tuple, or None if there is no such window. It makes a single
+    minimum-window pass over the merged positions, so it is linear in the number of positions, independent of the order of the sublists, and leaves A untouched.
+    Repeated search terms produce identical sublists, so those are folded together and the window must then hold that many of their positions'''
+
+    required_counts = {}
+    for positions in A:
+        required_counts[tuple(positions)] = required_counts.get(tuple(positions), 0) + 1
+
+    groups = list(required_counts)
+    required = [required_counts[group] for group in groups]
+
+    #merge the sublists into one sorted stream of (position, group) pairs
+    merged_positions = list(heapq.merge(*[[(position, g) for position in group] for g, group in enumerate(groups)]))
+
+    counts             = [0] * len(groups)
+    satisfied_groups   = 0
+    left               = 0
+    minimum_window     = None
+
+    for position, g in merged_positions:
+        counts[g] += 1
+        if counts[g] == required[g]:
+            satisfied_groups += 1
+
+        #while the window holds every term, record its span and then shrink it from the left
+        while satisfied_groups == len(groups):
+            left_position, left_g = merged_positions[left]
+            if minimum_window is None or position - left_position < minimum_window[0]:
+                minimum_window = (position - left_position, left_position, position)
+            if counts[left_g] == required[left_g]:
+                satisfied_groups -= 1
+            counts[left_g] -= 1
+            left += 1
+
+    return minimum_window
+
+
+def assign_distinct_positions(window_positions, groups_by_position, number_of_groups):
+
+    '''this function gives each of number_of_groups groups a distinct position of its own among window_positions, where groups_by_position lists the
+    groups each position can be given to, and returns the position given to each group, or None if there is no way to give every group one. It finds
+    the assignment with augmenting paths, so a position taken by one group is handed on to another if the first group can use a different one'''
+
+    candidate_positions = [[] for g in xrange(number_of_groups)]
+    for position in window_positions:
+        for g in groups_by_position[position]:
+            candidate_positions[g].append(position)
+
+    group_of_position = {}
+
+    def find_augmenting_path(g, visited_positions):
+        for position in candidate_positions[g]:
+            if position not in visited_positions:
+                visited_positions.add(position)
+                if position not in group_of_position or find_augmenting_path(group_of_position[position], visited_positions):
+                    group_of_position[position] = g
+                    return True
+        return False
+
+    for g in xrange(number_of_groups):
+        if not find_augmenting_path(g, set()):
+            return None
+
+    assigned_positions = [None] * number_of_groups
+    for position, g in group_of_position.items():
+        assigned_positions[g] = position
+    return assigned_positions
+
+
+def find_minimum_distinct_window(A, maximum_span):
+
+    '''this function reads in a list of sorted sublists of index positions, one sublist per term group, in which groups that share a variant share
+    some of their positions, and returns the shortest window (spanning no more than maximum_span words) in which every group can be given a distinct
+    position of its own, as a (span, first position, last position, assigned positions) tuple, or None if there is no such window. A position shared
+    by two groups only ever counts for one of them, so the window is never shorter than a match the text actually holds'''
+
+    groups_by_position = {}
+    for g, positions in enumerate(A):
+        for position in positions:
+            groups_by_position.setdefault(position, []).append(g)
+    positions = sorted(groups_by_position)
+
+    minimum_window = None
+    left = 0
+    for right in xrange(len(positions)):
+        while positions[right] - positions[left] > maximum_span:
+            left += 1
+
+        #while the window can give every group a position, record its span and then shrink it from the left
+        while left <= right:
+            assigned_positions = assign_distinct_positions(positions[left:right+1], groups_by_position, len(A))
+            if assigned_positions is None:
+                break
+            if minimum_window is None or positions[right] - positions[left] < minimum_window[0]:
+                minimum_window = (positions[right] - positions[left], positions[left], positions[right], assigned_positions)
+            left += 1
+
+    return minimum_window
+
+
+def groups_partly_share_variants(term_groups):
+
+    '''this function returns True if two of term_groups share some, but not all, of their variants. Their positions then partly overlap, and
+    find_minimum_covering_window (which folds together only groups with identical positions) could count one position for both'''
+
+    group_sets = [set(group) for group in term_groups]
+    return any( group_sets[i] & group_sets[j] and group_sets[i] != group_sets[j] for i in xrange(len(group_sets)) for j in xrange(i + 1, len(group_sets)) )
+
+
+def find_minimum_covering_span(A):
+
+    '''this function reads in a list of sorted sublists of index positions and returns the span (last position - first position) of the shortest window that holds every sublist, or None'''
+
+    minimum_window = find_minimum_covering_window(A)
+    if minimum_window:
+        return minimum_window[0]
+
+
 def check_for_proximity(A, threshold):
 
-    '''this function reads in a list of sublists and a threshold value (int). It then checks to see if there is a way of traversing the sublists with a maximum distance value = threshold parameter. For more details, see SO question 25249663'''
+    '''this function reads in a list of sublists and a threshold value (int). It returns True if one position from each sublist can be found within a window of threshold words'''
 
-    for i in range(len(A) - 1):
-        #print "Finding edges from layer", i, "to", i + 1, "..."
-        diffs = numpy.array(A[i]).reshape((-1, 1)) - numpy.array(A[i + 1]).reshape((1, -1))
-        reached = numpy.any(numpy.abs(diffs) <= threshold, axis = 0)
-        A[i + 1] = [A[i + 1][j] for j in range(len(reached)) if reached[j]]
-        #print "Reachable nodes of next layer:", A[i + 1]
-    return any(reached)
+    minimum_span = find_minimum_covering_span(A)
+    return minimum_span is not None and minimum_span <= threshold
 
     
 ########################
@@ -129,12 +328,16 @@ def check_for_proximity(A, threshold):
 
 def process_results_with_exact_function(search_terms, results):
 
+    #nltk takes most of a second to import, and only these file-based functions use it, so it isn't imported until they run
+    from nltk import clean_html
+
+    matches = []
     for hit in results:
                         
         #open file so we can grab highlights
         with codecs.open( hit["path"], "r", "utf-8") as fileobj:
             filecontents  = fileobj.read()
-            hit_highlights = hit.highlights("play_text", text=filecontents, top=100000)
+            hit_highlights = hit.highlights("content", text=filecontents, top=100000)
             
             #hit_highlight will now be a list of hits for each text. Let's split the list (n.b. this line assumes you've altered highlights.py source code to insert \t rather than *** between hits)
             list_of_hits = hit_highlights.split("\t")
@@ -142,11 +345,8 @@ def process_results_with_exact_function(search_terms, results):
             #iterate through these hits, which are still unclean (they have hit markup and they have punctuation)
             for dirty_hit in list_of_hits:
             
-                #clean the hit by first removing the html markup and then by removing punctuation and line breaks
-                clean_hit = remove_punctuation( clean_html(dirty_hit) ).replace(u"\n",u" ")
-                
-                #now encode clean_hit as utf-8 and split it
-                split_hit = clean_hit.encode("utf-8").split()
+                #clean the hit by removing the html markup, then tokenize it the same way the index does, encoding each word as utf-8
+                split_hit = [word.encode("utf-8") for word in tokenize( clean_html(dirty_hit) )]
                 
                 #in a moment, we'll compare each word in split_hit to each word of our search terms, and we'll record where the words in split_hit that match one of the search terms fall in split_hit (we'll record the index position of our search terms in split_hit)
                 bag_of_indices = []
@@ -170,13 +370,15 @@ def process_results_with_exact_function(search_terms, results):
                     
                     if check_for_path_through_indices( bag_of_indices ):
                         
-                        out.write( " ".join(search_terms).decode('utf-8')
+                        matches.append( " ".join(search_terms).decode('utf-8')
                         + "\t" + hit["author"].decode('utf-8')
-                        + "\t" + hit["filename"].decode('utf-8')
+                        + "\t" + path.basename(hit["path"]).decode('utf-8')
                         + "\t" + hit["path"].decode('utf-8')
                         + "\t" + "..." + " ".join(split_hit).decode('utf-8') + "..."
                         + "\n" )
                         
+    return matches
+                        
                         
 ############################
 # Proximity Match Function #
@@ -184,12 +386,15 @@ def process_results_with_exact_function(search_terms, results):
 
 def process_results_with_proximity_function(search_terms, results, proximity_value):
 
+    from nltk import clean_html
+
+    matches = []
     for hit in results:
                         
         #open file so we can grab highlights
         with codecs.open( hit["path"], "r", "utf-8") as fileobj:
             filecontents  = fileobj.read()
-            hit_highlight = hit.highlights("play_text", text=filecontents, top=100000)
+            hit_highlight = hit.highlights("content", text=filecontents, top=100000)
             
             #hit_highlight will now be a list of hits for each text. Let's split the list
             list_of_hits = hit_highlight.split("\t")
@@ -200,8 +405,8 @@ def process_results_with_proximity_function(search_terms, results, proximity_val
                 #clean the hit by first removing the html markup and then by removing punctuation and line breaks
                 clean_hit = remove_punctuation( clean_html(dirty_hit) ).replace(u"\n",u" ")
                 
-                #now encode clean_hit as utf-8 and split it
-                split_hit = clean_hit.encode("utf-8").split()
+                #now tokenize the hit the same way the index does, encoding each word as utf-8
+                split_hit = [word.encode("utf-8") for word in tokenize( clean_html(dirty_hit) )]
                 
                 #in a moment, we'll compare each word in split_hit to each word of our search terms, and we'll record where the words in split_hit that match one of the search terms fall in split_hit (we'll record the index position of our search terms in split_hit)
                 bag_of_indices = []
@@ -222,92 +427,896 @@ def process_results_with_proximity_function(search_terms, results, proximity_val
                 if len(bag_of_indices) == len(search_terms):
                 
                     '''Now the real work begins. We know that the current split_hit contains all of the words in k. To know if those words co-occur within
-                    a certain proximity of one-another, though, we use a function defined above, passing it the three lists of indices for each search
+                    a certain proximity of one-another, though, we use a function defined above, passing it the lists of indices for each search
                     term in our split_search_term. Say for example we have k = ["the","glory","days"] and the index positions for each of these words in
-                    the current hit are [10] [12] [14]. In that case, we want to determine whether there is a path across these arrays such that, for each
-                    "step" of the path, the distance of that step is less than the desired proximity value (three). See SO question 25249663'''
+                    the current hit are [10] [12] [14]. In that case, the shortest window containing all three words spans 14 - 10 = 4 words, and we keep
+                    the hit if that span is no greater than the desired proximity value'''
                     
-                    #we pass itertools bag_of_indices (a list of lists). Using permutations, we create a new list of lists for each possible arrangement of our initial sublists. 
-                    for i in itertools.permutations(bag_of_indices):
-                        new_list = []
-                        
-                        #because itertools returns a set of lists, and our function reads in a list of lists, we extend our new_list item with all members of i, which preserves the order of those members
-                        for j in i:
-                            new_list.extend([j])
-                            
-                        if check_for_proximity(new_list, proximity_value):
-                            out.write( " ".join(search_terms) + "\t" + hit["author"] + "\t" + hit["filename"] + "\t" + hit["path"] + "\t" + "..." + " ".join(clean_hit.split()) + "..." + "\n" )
-                            break
+                    if check_for_proximity(bag_of_indices, proximity_value):
+                        matches.append( " ".join(search_terms) + "\t" + hit["author"] + "\t" + path.basename(hit["path"]) + "\t" + hit["path"] + "\t" + "..." + " ".join(clean_hit.split()) + "..." + "\n" )
+
+    return matches
 
     
-###############
-# Run Queries #
-###############
+##############################################
+# Position-Based Match Verification Function #
+##############################################
 
-with codecs.open( find_outfile_name(), "w", "utf-8" ) as out:
-    ix = open_dir("/afs/crc.nd.edu/user/d/dduhaime/code/create_whoosh_index/index")
+def read_term_characters(searcher, term, docnums=None, fieldname="content"):
 
-    # the most important method on the Searcher object is search(), which takes a whoosh.query.Query object and returns a Results object
-    with ix.searcher() as searcher:
-    
-        #variable to keep track of when we reach the final window in the input text, and i=0 to set initial anchor for window at first word of input
-        end_of_input_text = 0
-        i = 0
+    '''this function reads the postings for term and returns a dictionary that maps each of the sorted docnums containing term to the
+    (position, startchar, endchar) tuples of that term within the document. The matcher only ever moves forward, skipping straight to each docnum.
+    If docnums is None, every document containing term is read'''
+
+    term_characters = {}
+    try:
+        matcher = searcher.postings(fieldname, term)
+    except TermNotFound:
+        return term_characters
         
-        while end_of_input_text == 0:
+    if docnums is None:
+        while matcher.is_active():
+            term_characters[matcher.id()] = matcher.value_as("characters")
+            matcher.next()
+        return term_characters
         
-            rolling_window = split_input_text[i:i+window_length]
+    for docnum in docnums:
+        if matcher.is_active() and matcher.id() < docnum:
+            matcher.skip_to(docnum)
+        if not matcher.is_active():
+            break
+        if matcher.id() == docnum:
+            term_characters[docnum] = matcher.value_as("characters")
             
-            #create a variable we'll use below to keep track of the number of hits we get for the words in this rolling window
-            number_of_hits_for_words_in_rolling_window = 0
-            bag_of_hits_for_words_in_rolling_window = []
+    return term_characters
+
+
+#the text stores the snippets are read from, keyed to their directories. Each process opens each store once
+text_stores = {}
+
+def find_text_store(stored_fields):
+
+    '''this function returns the text store that holds the text of the document with stored_fields: the one in the index directory, or in the document's shard'''
+
+    text_store_dir = path.join(index_directory, text_store_directory_name)
+    if sharded_index_desired == 1:
+        text_store_dir = path.join(index_directory, stored_fields["corpus"], text_store_directory_name)
+        
+    if text_store_dir not in text_stores:
+        text_stores[text_store_dir] = TextStore(text_store_dir)
+    return text_stores[text_store_dir]
+
+
+def format_match_from_postings(searcher, search_terms, docnum, match_window, group_characters, reported_matches, match_type):
+
+    '''this function formats a confirmed match as an outfile row, slicing the snippet around the matching positions out of the stored content, or out
+    of the text store if the index doesn't store content, and records it in reported_matches, an OrderedDict that holds the best match of each
+    match_type in each text as a (rank, outfile row) tuple. It returns None if reported_matches already holds a match of the same match_type in the
+    same text that is at least as good: one with a shorter window, or as short a window that starts earlier in the text'''
+    
+    characters_by_position = dict( (c[0], c) for characters in group_characters for c in characters )
+    startchar = characters_by_position[match_window[1]][1]
+    endchar   = characters_by_position[match_window[2]][2]
+    
+    stored_fields = searcher.stored_fields(docnum)
+    
+    #a document indexed as passages gives character offsets within the passage. Placing them within the whole text lets the passages of a text be
+    #folded into its single best match, just as the text would be reported if it had been indexed whole
+    passage_start = stored_fields.get("passage_start", 0)
+    match_key = (stored_fields["path"], match_type)
+    match_rank = (match_window[0], passage_start + startchar)
+    if match_key in reported_matches and reported_matches[match_key][0] <= match_rank:
+        return None
+    
+    with instrumentation.stage("snippets"):
+        if "content" in stored_fields:
+            snippet = stored_fields["content"][ max(0, startchar - snippet_context_characters) : endchar + snippet_context_characters ]
+        else:
+            snippet = find_text_store(stored_fields).read_characters(stored_fields["path"], passage_start + startchar - snippet_context_characters, passage_start + endchar + snippet_context_characters)
+    
+    match = " ".join(search_terms) + "\t" + stored_fields["author"] + "\t" + path.basename(stored_fields["path"]) + "\t" + stored_fields["path"] + "\t" + "..." + " ".join(remove_punctuation(snippet).split()) + "..." + "\n"
+    reported_matches[match_key] = (match_rank, match)
+    return match
+
+
+def find_reported_rows(reported_matches):
+
+    '''this function returns the outfile rows held in reported_matches, in the order their texts were first reported'''
+
+    return [match for match_rank, match in reported_matches.values()]
+
+
+def find_matched_variants(match_window, group_characters):
+
+    '''this function returns the variant that each term group matched inside match_window, giving each group a position of its own. It returns None
+    if the groups can't all be placed in the window, which can only happen when two groups partly share their variants, and those are verified with
+    find_minimum_distinct_window instead'''
+    
+    used_positions = set()
+    matched_variants = []
+    for characters in group_characters:
+        for c in characters:
+            if match_window[1] <= c[0] <= match_window[2] and c[0] not in used_positions:
+                used_positions.add(c[0])
+                matched_variants.append(c[3])
+                break
+        else:
+            return None
+    return matched_variants
+
+
+def process_results_from_postings(searcher, term_groups, docnums, maximum_matches=None, reported_matches=None):
+
+    '''this function verifies each hit in docnums with the positions of the search terms recorded in the index, so no file is opened, highlighted or
+    cleaned until a match is confirmed. term_groups holds one list of interchangeable variants for each word in the window, and each match is reported
+    with the variant combination that actually occurs in the text. The hits are verified in the order given, stopping once maximum_matches are found.
+    The matches are recorded in reported_matches (which may hold those of an earlier batch of hits), and every match it holds is returned'''
+    
+    if reported_matches is None:
+        reported_matches = OrderedDict()
+    
+    #read the postings for each distinct variant once, for all of the hits at the same time
+    term_characters = dict( (term, read_term_characters(searcher, term, sorted(docnums))) for group in term_groups for term in set(group) )
+    
+    for docnum in docnums:
+        if maximum_matches is not None and len(reported_matches) >= maximum_matches:
+            break
+        verify_document_from_postings(searcher, term_groups, docnum, term_characters, reported_matches, proximity_value)
+
+    return find_reported_rows(reported_matches)
+
+
+def verify_document_from_postings(searcher, term_groups, docnum, term_characters, reported_matches, maximum_span):
+
+    '''this function verifies one hit with the term_characters read from the postings, and records its matches in reported_matches: the proximity
+    match, if the shortest window holding every term group spans no more than maximum_span words, and then the exact match'''
+
+    #merge the postings of each group's variants into a single list of (position, startchar, endchar, variant) tuples, sorted by position
+    group_characters = [ sorted( c + (term,) for term in group for c in term_characters[term].get(docnum, ()) ) for group in term_groups ]
+    
+    #SpanNear2 only matches documents that contain every group, but check anyway so a group missing from the postings is skipped
+    if not all(group_characters):
+        return
+        
+    position_lists = [[c[0] for c in characters] for characters in group_characters]
+    
+    if proximity_search_desired == 1:
+        if groups_partly_share_variants(term_groups):
+            #each group is given a position of its own, and reports the variant found there
+            match_window = find_minimum_distinct_window(position_lists, maximum_span)
+            if match_window:
+                matched_variants = [ dict( (c[0], c[3]) for c in characters )[match_window[3][k]] for k, characters in enumerate(group_characters) ]
+                format_match_from_postings(searcher, matched_variants, docnum, match_window[:3], group_characters, reported_matches, "proximity")
+        else:
+            match_window = find_minimum_covering_window(position_lists)
+            if match_window and match_window[0] <= maximum_span:
+                matched_variants = find_matched_variants(match_window, group_characters)
+                if matched_variants:
+                    format_match_from_postings(searcher, matched_variants, docnum, match_window, group_characters, reported_matches, "proximity")
             
-            #now create a list of lists for the three words in the rolling window
-            list_containing_word_and_variant_lists = []
+    if exact_search_desired == 1 and not shingle_search_applies(term_groups):
+        match_window = find_exact_match_window(position_lists)
+        if match_window:
+            matched_variants = [ dict( (c[0], c[3]) for c in characters )[match_window[1] + k] for k, characters in enumerate(group_characters) ]
+            format_match_from_postings(searcher, matched_variants, docnum, match_window, group_characters, reported_matches, "exact")
+
+    
+##############################
+# Shingle Exact Match Search #
+##############################
+
+def shingle_search_applies(term_groups):
+
+    '''this function returns True if exact matches for term_groups should come from the content_shingles field rather than from verifying span hits'''
+
+    return shingle_search_desired == 1 and len(term_groups) >= shingle_size
+
+
+def run_exact_query_with_shingles(searcher, term_groups, maximum_matches=None, document_filter=None):
+
+    '''this function finds the exact matches for a window by intersecting the postings of its shingles. Shingle k of the window (each variant
+    combination of words k to k + shingle_size - 1) must occur at position p + k for some p, so no span query is run and no hit is verified.
+    Matches are found in index order, among the documents in document_filter if there is one, stopping once maximum_matches are found'''
+    
+    shingle_groups = [ [u" ".join(words) for words in itertools.product(*term_groups[k:k+shingle_size])] for k in xrange(len(term_groups) - shingle_size + 1) ]
+    
+    #read the rarest shingle group's postings in full, then read the others only for the documents still in the running
+    group_order = sorted( xrange(len(shingle_groups)), key=lambda k: sum( searcher.doc_frequency("content_shingles", shingle) for shingle in shingle_groups[k] ) )
+    group_characters_by_docnum = [None] * len(shingle_groups)
+    reported_matches = OrderedDict()
+    docnums = None
+    
+    for k in group_order:
+        shingle_characters = dict( (shingle, read_term_characters(searcher, shingle, docnums, "content_shingles")) for shingle in set(shingle_groups[k]) )
+        docnums = sorted( set( docnum for characters in shingle_characters.values() for docnum in characters ) )
+        if document_filter is not None:
+            docnums = [docnum for docnum in docnums if docnum in document_filter]
+        group_characters_by_docnum[k] = shingle_characters
+        if not docnums:
+            return []
             
-            #for each word currently in the rolling window, if user is using variant spellings, look up all orthographic equivalents to that word.
-            for j in rolling_window:
-                if variant_spelling_desired == 1:
-                    word_and_variants = find_orthographical_variants(j)
-                    if not word_and_variants:
-                        word_and_variants = [j]
-                    list_containing_word_and_variant_lists.append(word_and_variants)
-                else:
-                    list_containing_word_and_variant_lists.append(j)
-                    
-            #find all combinations of our three words with itertools.product, which takes list of lists and gives all combinations, e.g. A1,B1,C1, A1,B1,C2...An,Bn,Cn as a list
-            exhaustive_combinations = list(itertools.product(*list_containing_word_and_variant_lists))
+    for docnum in docnums:
+        if maximum_matches is not None and len(reported_matches) >= maximum_matches:
+            break
+    
+        #merge each group's shingle postings into a list of (position, startchar, endchar, shingle) tuples, sorted by position
+        group_characters = [ sorted( c + (shingle,) for shingle in set(shingle_groups[k]) for c in group_characters_by_docnum[k][shingle].get(docnum, ()) ) for k in xrange(len(shingle_groups)) ]
+        match_window = find_exact_match_window( [[c[0] for c in characters] for characters in group_characters] )
+        
+        if match_window:
+            #rebuild the matched words from the shingles: all of the first shingle, then the last word of each shingle after it
+            matched_shingles = [ dict( (c[0], c[3]) for c in characters )[match_window[1] + k] for k, characters in enumerate(group_characters) ]
+            matched_variants = matched_shingles[0].split(u" ") + [shingle.split(u" ")[-1] for shingle in matched_shingles[1:]]
+            format_match_from_postings(searcher, matched_variants, docnum, match_window, group_characters, reported_matches, "exact")
             
-            #now we need only iterate through exhaustive_combinations, searching for each, and writing any hits to outfile
-            for search_terms in exhaustive_combinations:
+    return find_reported_rows(reported_matches)
+
+    
+####################
+# Document Filters #
+####################
+
+#the bitsets built for each year range and corpus, and the document filter combined from them, keyed to the index generation they were built from.
+#Each process builds its own, once
+filter_bitsets = {}
+
+def split_year_range(start_year, end_year):
+
+    '''this function splits the inclusive year range start_year to end_year into blocks of year_filter_granularity years (e.g. decades) aligned to
+    multiples of it, plus the odd years at either end, so that ranges covering the same decades share those decades' bitsets'''
+
+    year_blocks = []
+    year = start_year
+    while year <= end_year:
+        block_end = min( year - year % year_filter_granularity + year_filter_granularity - 1, end_year )
+        year_blocks.append( (year, block_end) )
+        year = block_end + 1
+    return year_blocks
+
+
+def find_filter_bitset(searcher, index_generation, filter_query):
+
+    '''this function returns a BitSet of the documents matching filter_query, building it the first time it is asked for'''
+
+    filter_key = (index_generation, filter_query)
+    if filter_key not in filter_bitsets:
+        filter_bitsets[filter_key] = BitSet(searcher.docs_for_query(filter_query), size=searcher.doc_count_all())
+    return filter_bitsets[filter_key]
+
+
+def find_document_filter(searcher, index_generation):
+
+    '''this function returns a BitSet of the documents within searched_year_ranges and searched_corpora, or None if neither is set. The combined filter is
+    built from the year and corpus bitsets once per index generation, and then comes from filter_bitsets'''
+
+    #an empty list of year ranges or corpora filters out every document, while None filters nothing, so the two are kept apart in the key
+    filter_key = (index_generation, "document filter", searched_year_ranges and tuple(tuple(year_range) for year_range in searched_year_ranges),
+                  searched_corpora and tuple(searched_corpora))
+    if filter_key in filter_bitsets:
+        return filter_bitsets[filter_key]
+
+    document_filter = None
+    
+    if searched_year_ranges is not None:
+        year_bitsets = [ find_filter_bitset(searcher, index_generation, NumericRange("year", block_start, block_end))
+                         for start_year, end_year in searched_year_ranges for block_start, block_end in split_year_range(start_year, end_year) ]
+        document_filter = reduce(lambda a, b: a.union(b), year_bitsets, BitSet(size=searcher.doc_count_all()))
+        
+    if searched_corpora is not None:
+        corpus_bitsets = [ find_filter_bitset(searcher, index_generation, Term("corpus", unicode(corpus))) for corpus in searched_corpora ]
+        corpus_filter = reduce(lambda a, b: a.union(b), corpus_bitsets, BitSet(size=searcher.doc_count_all()))
+        document_filter = corpus_filter if document_filter is None else document_filter.intersection(corpus_filter)
+        
+    filter_bitsets[filter_key] = document_filter
+    return document_filter
+
+
+#############
+# Run Query #
+#############
+
+def find_ranked_candidate_batches(searcher, q, document_filter=None):
+
+    '''generator that yields the documents matching q (and document_filter, if there is one) in batches, ranked as top_k_ranking asks. It only asks the
+    searcher for more documents once every batch before has been verified, so a query that finds its matches among the first candidates never collects the rest'''
+
+    if top_k_ranking == "index order":
+        #docs_for_query walks the matching documents in index order without scoring them, and stops as soon as we stop asking
+        candidate_docnums = searcher.docs_for_query(q)
+        if document_filter is not None:
+            candidate_docnums = itertools.ifilter(document_filter.__contains__, candidate_docnums)
+        while True:
+            batch = list( itertools.islice(candidate_docnums, maximum_number_of_hits_per_query) )
+            if not batch:
+                return
+            yield batch
             
-                #list of query components will start empty, we'll populate it, then submit our query
-                list_of_query_components = []
+    else:
+        #the collector keeps only the best limit documents, so ask for a few at first and for four times as many whenever those run out
+        #indices built before the numeric year field existed can only be sorted by the publication_year text
+        sortedby = None
+        if top_k_ranking == "publication year":
+            sortedby = "year" if "year" in searcher.schema else "publication_year"
+        limit = maximum_number_of_hits_per_query
+        number_verified = 0
+        while True:
+            results = searcher.search(q, limit=limit, sortedby=sortedby, filter=document_filter)
+            ranked_docnums = [results.docnum(n) for n in xrange(results.scored_length())]
+            if ranked_docnums[number_verified:]:
+                yield ranked_docnums[number_verified:]
+            if results.scored_length() < limit:
+                return
+            number_verified = len(ranked_docnums)
+            limit *= 4
+
+
+def run_top_k_span_query(searcher, term_groups, q, document_filter=None):
+
+    '''this function verifies the documents matching the span query q in ranked batches, and stops as soon as maximum_number_of_hits_per_query matches
+    have been verified'''
+
+    reported_matches = OrderedDict()
+    candidate_batches = find_ranked_candidate_batches(searcher, q, document_filter)
+    while len(reported_matches) < maximum_number_of_hits_per_query:
+        with instrumentation.stage("span query"):
+            batch = next(candidate_batches, None)
+        if batch is None:
+            break
+        instrumentation.count("hits", len(batch))
+        
+        with instrumentation.stage("verify"):
+            process_results_from_postings(searcher, term_groups, batch, maximum_number_of_hits_per_query, reported_matches)
+    return find_reported_rows(reported_matches)
+
+
+def build_span_query(term_groups, slop):
+
+    '''this function returns the SpanNear2 query for a rolling window, given as a list containing the variants to accept for each of its words'''
+
+    #list of query components will start empty, we'll populate it, then submit our query
+    list_of_query_components = []
+    
+    #iterate through the term groups and add each to our list_of_query_components. A word with variants becomes a single SpanOr clause, so one query covers every variant combination
+    for group in term_groups:
+        if len(group) == 1:
+            query_component = Term("content", group[0])
+        else:
+            query_component = spans.SpanOr([Term("content", term) for term in group])
+        list_of_query_components.append(query_component)
+        
+    #now take all of those query components and submit them to the spans.SpanNear2 function, which (loosely speaking) facilitates proximity search (with high recall and low precision, thus why we have to iterate through all results and select only the true matches in our process_results() function defined above and called below)
+    return spans.SpanNear2(list_of_query_components, slop=slop, ordered=False)
+
+
+def run_span_query(searcher, term_groups, document_filter=None):
+
+    '''this function runs a SpanNear2 query for one rolling window, given as a list containing the variants to accept for each of its words, and returns the
+    verified matches as a list of outfile rows. If there is a document_filter, only the documents in it are collected and verified'''
+
+    q = build_span_query(term_groups, proximity_value)
+    
+    #in top-k mode the hits are verified a batch at a time, in ranked order, until enough matches are found
+    if top_k_desired == 1 and postings_verification_desired == 1:
+        return run_top_k_span_query(searcher, term_groups, q, document_filter)
+     
+    #by default the results contains at most the first 10 matching documents. To get more results, use the limit keyword: results = searcher.search(q, limit=20). printing "results" object is handy because it gives runtime for each query. Terms=true allows us to determine which of the search terms each hit has
+    with instrumentation.stage("span query"):
+        results = searcher.search(q, limit=None, terms=True, filter=document_filter)
+    instrumentation.count("hits", len(results))
+    
+    #the following line allows one to retrieve hits from farther into the document than 32K characters (so if character 32,001 is the beginning of a new word that matches query, we can grab that hit with the following line but will fail to catch it without that line)
+    results.fragmenter.charlimit = None
+    
+    matches = []
+    if results:
+        if postings_verification_desired == 1:
+            with instrumentation.stage("verify"):
+                matches.extend( process_results_from_postings(searcher, term_groups, sorted(results.docs())) )
+        
+        else:
+            #the file-based functions check a single combination of search terms, so search_window only hands them groups of one term
+            search_terms = [group[0] for group in term_groups]
+            
+            with instrumentation.stage("highlight and verify"):
+                if proximity_search_desired == 1:
+                    matches.extend( process_results_with_proximity_function(search_terms, results, proximity_value) )
                 
-                #iterate through search terms and add each to our list_of_query_components
-                for term in search_terms:
-                    query_component = Term("content", term)
-                    list_of_query_components.append(query_component)
-                    
-                #now take all of those query components and submit them to the spans.SpanNear2 function, which (loosely speaking) facilitates proximity search (with high recall and low precision, thus why we have to iterate through all results and select only the true matches in our process_results() function defined above and called below)
-                q = spans.SpanNear2(list_of_query_components, slop=proximity_value, ordered=False)
-                 
-                #by default the results contains at most the first 10 matching documents. To get more results, use the limit keyword: results = searcher.search(q, limit=20). printing "results" object is handy because it gives runtime for each query. Terms=true allows us to determine which of the search terms each hit has
-                results = searcher.search(q, limit=None, terms=True)
+                if exact_search_desired == 1 and not shingle_search_applies(term_groups):
+                    matches.extend( process_results_with_exact_function(search_terms, results) )
+                
+    return matches
+
+
+def run_query(searcher, term_groups, document_filter=None):
+
+    '''this function searches the index for one rolling window and returns the verified matches as a list of outfile rows. Exact matches come from the
+    shingle postings when they can, and everything else from a verified span query'''
+    
+    matches = []
+    if proximity_search_desired == 1 or (exact_search_desired == 1 and not shingle_search_applies(term_groups)):
+        matches.extend( run_span_query(searcher, term_groups, document_filter) )
+        
+    if exact_search_desired == 1 and shingle_search_applies(term_groups):
+        with instrumentation.stage("shingle query"):
+            matches.extend( run_exact_query_with_shingles(searcher, term_groups, maximum_number_of_hits_per_query - len(matches) if top_k_desired == 1 else None, document_filter) )
+        
+    return matches
+
+
+def find_query_cache_key(index_generation, term_groups):
+
+    '''this function returns the key under which the matches for term_groups are cached. It holds every parameter that can change those matches, along with the index directory and generation, so results cached before the index was re-committed or rebuilt are never reused'''
+
+    return (tuple(tuple(group) for group in term_groups), proximity_value, proximity_search_desired, exact_search_desired, postings_verification_desired, shingle_search_desired,
+            top_k_desired, maximum_number_of_hits_per_query, top_k_ranking, tuple(tuple(year_range) for year_range in searched_year_ranges or ()), tuple(searched_corpora or ()),
+            snippet_context_characters, index_directory, index_generation)
+
+
+def create_query_result_cache():
+
+    '''this function creates the query result cache described by the search parameters'''
+
+    return QueryResultCache(query_cache_size, persistent_query_cache_path if persistent_query_cache_desired == 1 else None)
+
+
+#the co-occurrence prefilter is built (or loaded) once, before any worker processes are started, so they all share it
+cooccurrence_prefilter = None
+
+def create_cooccurrence_prefilter(split_input_text):
+
+    '''this function builds the co-occurrence prefilter for the words of the input text and their variants, or loads it from cooccurrence_prefilter_path
+    if it was saved there for the same index (its directory and generation, which changes on every rebuild as well as every commit), vocabulary, and prefilter parameters.
+    A prefilter saved for another build of the index would test the documents of that build, and skip queries that now match'''
+
+    prefilter_terms = sorted( set( term for group in find_word_variant_lists(split_input_text) for term in group ) )
+    prefilter = CooccurrencePrefilter(prefilter_frequent_document_fraction, prefilter_false_positive_rate)
+    
+    searcher, index_generation = open_searcher()
+    with searcher:
+        prefilter_key = hashlib.md5( repr( (index_directory, index_generation, prefilter_terms, prefilter_frequent_document_fraction, prefilter_false_positive_rate) ) ).hexdigest()
+        if not prefilter.load(cooccurrence_prefilter_path, prefilter_key):
+            print "building the co-occurrence prefilter for", len(prefilter_terms), "words"
+            with instrumentation.stage("build prefilter"):
+                prefilter.build(searcher, prefilter_terms)
+            prefilter.save(cooccurrence_prefilter_path, prefilter_key)
+    return prefilter
+
+    
+####################
+# Federated Search #
+####################
+
+def find_searched_shards():
+
+    '''this function returns the names of the shards to search: searched_shards if it is set, otherwise every shard in index_directory'''
+
+    if searched_shards is not None:
+        return list(searched_shards)
+    return sorted( shard_name for shard_name in listdir(index_directory) if exists_in(path.join(index_directory, shard_name)) )
+
+
+def read_index_generation(ix):
+
+    '''this function returns the generation of the index ix along with the ids of its segments. A full rebuild starts counting generations again, but
+    every segment it writes gets a new random id, so the pair identifies the committed state of the index across rebuilds as well as commits'''
+
+    toc = TOC.read(ix.storage, ix.indexname)
+    return (toc.generation, tuple(segment.segment_id() for segment in toc.segments))
+
+
+def open_searcher():
+
+    '''this function opens a searcher over the index, or over the searched shards of a sharded index, and returns it along with the index generation
+    (see read_index_generation), which identifies the committed state of everything the searcher reads'''
+
+    if sharded_index_desired != 1:
+        ix = open_dir(index_directory)
+        return ix.searcher(), read_index_generation(ix)
+        
+    #the segments of every searched shard are read through a single MultiReader, so the shards are searched together, with their document frequencies and scores
+    #combined, and the shards that aren't searched are never opened
+    shard_readers = []
+    index_generation = []
+    for shard_name in find_searched_shards():
+        shard_index = open_dir(path.join(index_directory, shard_name))
+        shard_readers.extend( reader for reader, offset in shard_index.reader().leaf_readers() )
+        index_generation.append( (shard_name, read_index_generation(shard_index)) )
+        
+    return Searcher(MultiReader(shard_readers)), tuple(index_generation)
+
+
+def find_index_generation():
+
+    '''this function returns the generation that open_searcher would return now, without opening a searcher, so a long-running search can tell when the index has been committed again or rebuilt'''
+
+    if sharded_index_desired != 1:
+        return read_index_generation(open_dir(index_directory))
+    return tuple( (shard_name, read_index_generation(open_dir(path.join(index_directory, shard_name)))) for shard_name in find_searched_shards() )
+
+
+##################
+# Search Windows #
+##################
+
+def find_rolling_windows(split_input_text):
+
+    '''this function returns a (window start, window words) pair for each rolling window over the input text, in input order'''
+
+    final_window_start = max(len(split_input_text) - window_length, 0)
+    return [(i, split_input_text[i:i+window_length]) for i in xrange(0, final_window_start + 1, window_slide_interval)]
+
+
+def plan_query(searcher, term_groups):
+
+    '''this function reads the document frequency of each term group (the sum over its variants) from the searcher and returns them as a list. It
+    stops at the first group with a frequency of zero, since the query can't match, and leaves the groups after it as None'''
+
+    group_frequencies = [None] * len(term_groups)
+    for k, group in enumerate(term_groups):
+        group_frequencies[k] = sum( searcher.doc_frequency("content", term) for term in group )
+        if group_frequencies[k] == 0:
+            break
+    return group_frequencies
+
+
+def find_word_variant_lists(rolling_window):
+
+    '''this function returns a list containing, for each word in the rolling window, the list of spellings to search for it: the word itself, or all of
+    its orthographic variants if they're desired'''
+
+    #now create a list of lists for the three words in the rolling window
+    list_containing_word_and_variant_lists = []
+    
+    #for each word currently in the rolling window, if user is using variant spellings, look up all orthographic equivalents to that word.
+    for j in rolling_window:
+        word_and_variants = [j]
+        if variant_spelling_desired == 1:
+            with instrumentation.stage("variant lookup"):
+                word_and_variants = find_orthographical_variants(j) or [j]
+            
+        #drop any repeated variants, keeping the order in which they were listed
+        list_containing_word_and_variant_lists.append( [v for k, v in enumerate(word_and_variants) if v not in word_and_variants[:k]] )
+    return list_containing_word_and_variant_lists
+
+
+def search_window(searcher, index_generation, query_result_cache, rolling_window, apply_cost_ceiling=True):
+
+    '''this function searches the index for one rolling window, with each word's orthographic variants if they're desired. It returns the verified matches
+    as a list of outfile rows, along with a list of (reason, term groups, document frequencies) tuples for the queries the planner skipped'''
+
+    window_matches = []
+    window_skips = []
+    list_containing_word_and_variant_lists = find_word_variant_lists(rolling_window)
+        
+    #verifying from postings handles every variant combination in a single query. The file-based functions can't, so for them find all combinations of our three words with itertools.product, which takes list of lists and gives all combinations, e.g. A1,B1,C1, A1,B1,C2...An,Bn,Cn as a list
+    if postings_verification_desired == 1:
+        window_queries = [list_containing_word_and_variant_lists]
+    else:
+        window_queries = [[[term] for term in search_terms] for search_terms in itertools.product(*list_containing_word_and_variant_lists)]
+        
+    #the year and corpus filter is built once per process and index generation, and then comes from filter_bitsets
+    document_filter = find_document_filter(searcher, index_generation)
+    
+    #whoosh treats an empty filter as no filter at all, so a filter that excludes every document has to be handled here
+    if document_filter is not None and not document_filter:
+        return window_matches, window_skips
+    
+    #plan each query before running any of them. A query containing a word that appears in no document can't match, so it is dropped outright
+    planned_queries = []
+    for term_groups in window_queries:
+        group_frequencies = None
+        if query_planner_desired == 1:
+            with instrumentation.stage("plan"):
+                group_frequencies = plan_query(searcher, term_groups)
+            if 0 in group_frequencies:
+                window_skips.append( ("absent term", term_groups, group_frequencies) )
+                continue
+        planned_queries.append( (term_groups, group_frequencies) )
+        
+    #a window whose queries are made only of very frequent words (e.g. "and of the") matches most of the corpus, so it is skipped or deferred as a whole
+    if apply_cost_ceiling and query_planner_desired == 1 and maximum_planned_document_frequency is not None and planned_queries:
+        if all( min(group_frequencies) > maximum_planned_document_frequency for term_groups, group_frequencies in planned_queries ):
+            window_skips.extend( ("frequent terms", term_groups, group_frequencies) for term_groups, group_frequencies in planned_queries )
+            return window_matches, window_skips
+    
+    #now we need only iterate through the queries, searching for each, and collecting any hits
+    for term_groups, group_frequencies in planned_queries:
+    
+        #a query whose words never share a document can't match, so it is skipped before a span query is even built
+        if cooccurrence_prefilter is not None:
+            with instrumentation.stage("prefilter"):
+                may_cooccur = cooccurrence_prefilter.may_cooccur(searcher, term_groups)
+            if not may_cooccur:
+                window_skips.append( ("no shared document", term_groups, group_frequencies or [None] * len(term_groups)) )
+                continue
+    
+        #a word sequence we've already searched for (in an earlier window, or in an earlier run if the persistent cache is on) comes straight from the cache
+        query_cache_key = find_query_cache_key(index_generation, term_groups)
+        with instrumentation.stage("cache lookup"):
+            matches = query_result_cache.get(query_cache_key)
+        if matches is None:
+            matches = run_query(searcher, term_groups, document_filter)
+            instrumentation.count("queries")
+            query_result_cache.put(query_cache_key, matches)
+            
+        window_matches.extend(matches)
+        
+    return window_matches, window_skips
+
+
+def search_and_time_window(searcher, index_generation, query_result_cache, rolling_window, apply_cost_ceiling):
+
+    '''this function searches one (window start, window words) rolling window and records how long it took, along with its matches and skips'''
+
+    window_started = time.time()
+    window_matches, window_skips = search_window(searcher, index_generation, query_result_cache, rolling_window[1], apply_cost_ceiling)
+    
+    instrumentation.count("windows")
+    instrumentation.count("matches", len(window_matches))
+    instrumentation.count("skipped queries", len(window_skips))
+    instrumentation.record_latency("window", str(rolling_window[0]) + " " + " ".join(rolling_window[1]), time.time() - window_started)
+    return window_matches, window_skips
+
+
+###################
+# Parallel Search #
+###################
+
+def split_into_shares(rolling_windows, number_of_shares):
+
+    '''this function splits rolling_windows into at most number_of_shares contiguous lists, so each share's matches can be written back in input order'''
+
+    share_size = max(1, int(math.ceil(len(rolling_windows) / float(number_of_shares))))
+    return [rolling_windows[k:k+share_size] for k in xrange(0, len(rolling_windows), share_size)]
+
+
+def initialize_search_worker():
+
+    '''pool initializer: each worker opens the index, one searcher, and one query result cache, and keeps them for the whole run'''
+
+    #a worker is forked with everything the parent's instrumentation has recorded so far, which the parent would otherwise get back in the worker's first snapshot
+    instrumentation.reset()
+
+    global worker_searcher, worker_index_generation, worker_query_result_cache
+    worker_searcher, worker_index_generation = open_searcher()
+    worker_query_result_cache = create_query_result_cache()
+
+
+def search_window_share(share_arguments):
+
+    '''worker function: search each window in a share and return the (matches, skips) for each window, along with the cache and prefilter counts the
+    share added and what the worker's instrumentation recorded for the share'''
+
+    window_share, apply_cost_ceiling = share_arguments
+    
+    counts_before = worker_query_result_cache.counts()
+    prefilter_counts_before = cooccurrence_prefilter.counts() if cooccurrence_prefilter is not None else ()
+    share_results = [search_and_time_window(worker_searcher, worker_index_generation, worker_query_result_cache, rolling_window, apply_cost_ceiling) for rolling_window in window_share]
+    worker_query_result_cache.commit()
+    
+    share_counts = [after - before for after, before in zip(worker_query_result_cache.counts(), counts_before)]
+    share_prefilter_counts = [after - before for after, before in zip(cooccurrence_prefilter.counts(), prefilter_counts_before)] if cooccurrence_prefilter is not None else None
+    return share_results, share_counts, share_prefilter_counts, instrumentation.take_snapshot()
+
+
+def search_windows_in_parallel(rolling_windows, query_result_cache, apply_cost_ceiling=True):
+
+    '''this function spreads the rolling windows across a pool of worker processes and yields (window, matches, skips) for each window in input order'''
+
+    window_shares = split_into_shares(rolling_windows, number_of_worker_processes * window_shares_per_worker_process)
+    
+    pool = multiprocessing.Pool(number_of_worker_processes, initialize_search_worker)
+    try:
+        #imap hands back the shares in input order, even when they finish out of order
+        share_results = pool.imap(search_window_share, [(window_share, apply_cost_ceiling) for window_share in window_shares])
+        for window_share, (window_results, share_counts, share_prefilter_counts, share_snapshot) in itertools.izip(window_shares, share_results):
+            query_result_cache.add_counts(share_counts)
+            if share_prefilter_counts is not None:
+                cooccurrence_prefilter.add_counts(share_prefilter_counts)
+            instrumentation.add_snapshot(share_snapshot)
+            for rolling_window, (window_matches, window_skips) in zip(window_share, window_results):
+                yield rolling_window, window_matches, window_skips
+    finally:
+        pool.close()
+        pool.join()
+
+
+def search_windows_serially(rolling_windows, query_result_cache, apply_cost_ceiling=True):
+
+    '''this function searches each rolling window in turn with a single searcher and yields (window, matches, skips) for each window in input order'''
+
+    searcher, index_generation = open_searcher()
+    
+    # the most important method on the Searcher object is search(), which takes a whoosh.query.Query object and returns a Results object
+    with searcher:
+        for rolling_window in rolling_windows:
+            window_matches, window_skips = search_and_time_window(searcher, index_generation, query_result_cache, rolling_window, apply_cost_ceiling)
+            yield rolling_window, window_matches, window_skips
+
+
+def search_windows(rolling_windows, query_result_cache, apply_cost_ceiling=True):
+
+    '''this function searches the rolling windows in parallel or serially, as the search parameters ask'''
+
+    if parallel_search_desired == 1:
+        return search_windows_in_parallel(rolling_windows, query_result_cache, apply_cost_ceiling)
+    return search_windows_serially(rolling_windows, query_result_cache, apply_cost_ceiling)
+
+
+def write_window_results(out, window_results, skipped_queries, deferred_windows, number_of_windows):
+
+    '''this function writes each window's matches to out, and sorts the planner's skips into the windows to defer and the queries to report as skipped'''
+
+    for window_number, (rolling_window, window_matches, window_skips) in enumerate(window_results):
+        instrumentation.show_progress(window_number + 1, number_of_windows, "windows")
+        
+        for match in window_matches:
+            out.write( match )
+            
+        if window_skips and window_skips[0][0] == "frequent terms" and frequent_window_policy == "defer":
+            deferred_windows.append(rolling_window)
+        else:
+            skipped_queries.extend( (rolling_window[0],) + window_skip for window_skip in window_skips )
+
+
+def write_skipped_queries(skipped_queries, skipped_queries_file_name):
+
+    '''this function writes one row per skipped query (window start, reason, each word's variants, and each word's document frequency) and prints a count of the skips by reason'''
+
+    with codecs.open( skipped_queries_file_name, "w", "utf-8" ) as skipped_out:
+        for window_start, reason, term_groups, group_frequencies in skipped_queries:
+            skipped_out.write( str(window_start) + "\t" + reason + "\t" + " ".join( u"|".join(group) for group in term_groups ) + "\t" + " ".join( "-" if f is None else str(f) for f in group_frequencies ) + "\n" )
+            
+    skip_counts = {}
+    for skipped_query in skipped_queries:
+        skip_counts[skipped_query[1]] = skip_counts.get(skipped_query[1], 0) + 1
+    print "query planner skipped:", ", ".join( "%d (%s)" % (skip_counts[reason], reason) for reason in sorted(skip_counts) ) or "nothing"
+
+    
+###################
+# Parameter Sweep #
+###################
+
+def sweep_window(searcher, document_filter, window_start, window_words, number_of_words):
+
+    '''this function searches once for every swept window length that starts at window_start, and returns a dictionary that maps each of those window
+    lengths to the (span, outfile row) tuples of its matches, in the order a run with that window length would write them. Exact matches have a span
+    of None. window_words holds the longest swept window, which begins with every shorter one'''
+
+    swept_matches = {}
+    term_groups = find_word_variant_lists(window_words)
+    largest_proximity_value = max(swept_proximity_values)
+    
+    #a run with a given window length has a window at each start up to the last full window, or a single window if the input is shorter than that
+    window_lengths = [length for length in sorted(swept_window_lengths) if window_start <= max(number_of_words - length, 0)]
+    
+    #any document that holds a longer window within some proximity holds the shortest window within that proximity too, so the hits for the shortest
+    #window at the largest proximity value are the candidates for every setting
+    candidate_groups = term_groups[:window_lengths[0]]
+    if query_planner_desired == 1:
+        with instrumentation.stage("plan"):
+            if 0 in plan_query(searcher, candidate_groups):
+                return swept_matches
                 
-                #the following line allows one to retrieve hits from farther into the document than 32K characters (so if character 32,001 is the beginning of a new word that matches query, we can grab that hit with the following line but will fail to catch it without that line)
-                results.fragmenter.charlimit = None
+    if cooccurrence_prefilter is not None:
+        with instrumentation.stage("prefilter"):
+            if not cooccurrence_prefilter.may_cooccur(searcher, candidate_groups):
+                return swept_matches
+    
+    with instrumentation.stage("span query"):
+        docnums = sorted( searcher.search(build_span_query(candidate_groups, largest_proximity_value), limit=None, filter=document_filter).docs() )
+    instrumentation.count("hits", len(docnums))
+    
+    #read the postings of the longest window once, and measure the span of every window length in every hit
+    with instrumentation.stage("verify"):
+        term_characters = dict( (term, read_term_characters(searcher, term, docnums)) for group in term_groups for term in set(group) )
+        reported_matches = dict( (length, OrderedDict()) for length in window_lengths )
+        for docnum in docnums:
+            for length in window_lengths:
+                verify_document_from_postings(searcher, term_groups[:length], docnum, term_characters, reported_matches[length], largest_proximity_value)
+        
+        #a proximity match's rank begins with its span, and the best match in each text is the one with the shortest span, whichever proximity value is swept
+        for length in window_lengths:
+            swept_matches[length] = [ (match_rank[0] if match_type == "proximity" else None, match) for (match_path, match_type), (match_rank, match) in reported_matches[length].items() ]
+    
+    #exact matches for windows at least as long as a shingle come from the shingle postings, after the span hits, just as run_query adds them
+    if exact_search_desired == 1:
+        for length in window_lengths:
+            if shingle_search_applies(term_groups[:length]):
+                with instrumentation.stage("shingle query"):
+                    swept_matches[length].extend( (None, match) for match in run_exact_query_with_shingles(searcher, term_groups[:length], None, document_filter) )
                 
-                #add the current results to a bag of results for our three terms (e.g. find all results for all variant spellings of "so so now", then count up the total number of times that series of words yielded hits)
-                if results:
-                    if proximity_search_desired == 1:
-                        process_results_with_proximity_function(search_terms, results, proximity_value)
-                    
-                    if exact_search_desired == 1:
-                        process_results_with_exact_function(search_terms, results)
+    return swept_matches
+
+
+def run_parameter_sweep(split_input_text):
+
+    '''this function searches the input text in a single pass and writes an outfile for each combination of swept_proximity_values and swept_window_lengths,
+    holding the rows that a run with that proximity value and window length would write. It returns the names of the outfiles'''
+
+    #each outfile is opened as soon as it is named, so that settings whose names run together (e.g. 1 and 23, and 12 and 3) get outfiles of their own
+    outfile_names = {}
+    outfiles = {}
+    for swept_proximity_value in swept_proximity_values:
+        for swept_window_length in swept_window_lengths:
+            outfile_names[(swept_proximity_value, swept_window_length)] = find_outfile_name(swept_proximity_value, swept_window_length)
+            outfiles[(swept_proximity_value, swept_window_length)] = codecs.open( outfile_names[(swept_proximity_value, swept_window_length)], "w", "utf-8" )
+    
+    longest_window_length = max(swept_window_lengths)
+    window_starts = range(0, max(len(split_input_text) - min(swept_window_lengths), 0) + 1, window_slide_interval)
+    
+    searcher, index_generation = open_searcher()
+    with searcher:
+        document_filter = find_document_filter(searcher, index_generation)
+        
+        for window_number, window_start in enumerate(window_starts):
+            window_started = time.time()
+            window_words = split_input_text[window_start : window_start + longest_window_length]
+            
+            #whoosh treats an empty filter as no filter at all, so a filter that excludes every document has to be handled here
+            swept_matches = {}
+            if document_filter is None or document_filter:
+                swept_matches = sweep_window(searcher, document_filter, window_start, window_words, len(split_input_text))
+            
+            #each match goes to the outfile of every proximity value its span is within. Exact matches hold for every proximity value
+            for length in sorted(swept_matches):
+                for match_span, match in swept_matches[length]:
+                    instrumentation.count("matches")
+                    for swept_proximity_value in swept_proximity_values:
+                        if match_span is None or match_span <= swept_proximity_value:
+                            outfiles[(swept_proximity_value, length)].write( match )
+                            
+            instrumentation.count("windows")
+            instrumentation.record_latency("window", str(window_start) + " " + " ".join(window_words), time.time() - window_started)
+            instrumentation.show_progress(window_number + 1, len(window_starts), "windows")
+            
+    for outfile in outfiles.values():
+        outfile.close()
+    return [outfile_names[setting] for setting in sorted(outfile_names)]
+
+    
+###############
+# Run Queries #
+###############
+
+if __name__ == "__main__":
+
+    #a parameter sweep measures the span of each match from the positions in the postings, so it needs postings verification
+    split_input_text = load_input_text()
+    if cooccurrence_prefilter_desired == 1:
+        cooccurrence_prefilter = create_cooccurrence_prefilter(split_input_text)
+    
+    if parameter_sweep_desired == 1 and postings_verification_desired == 1:
+        outfile_names = run_parameter_sweep(split_input_text)
+        print "wrote", len(outfile_names), "outfiles, from", outfile_names[0], "to", outfile_names[-1]
+        
+        if cooccurrence_prefilter is not None:
+            print cooccurrence_prefilter.report()
+        
+        instrumentation.write_report(outfile_names[0][:-4] + "_instrumentation.json")
+        
+    else:
+        rolling_windows = find_rolling_windows(split_input_text)
+        query_result_cache = create_query_result_cache()
+        
+        skipped_queries = []
+        deferred_windows = []
+        outfile_name = find_outfile_name()
+        
+        with codecs.open( outfile_name, "w", "utf-8" ) as out:
+            write_window_results(out, search_windows(rolling_windows, query_result_cache), skipped_queries, deferred_windows, len(rolling_windows))
+            
+            #the deferred windows are searched last, once every cheaper window has been written
+            if deferred_windows:
+                print "searching", len(deferred_windows), "deferred windows"
+                write_window_results(out, search_windows(deferred_windows, query_result_cache, apply_cost_ceiling=False), skipped_queries, deferred_windows, len(deferred_windows))
                     
-            #check to make sure window can advance, and if it can, advance it:            
-            if i + window_length + window_slide_interval <= len(split_input_text):
-                i += window_slide_interval
-            else:
-                end_of_input_text = 1
\ No newline at end of file
+        write_skipped_queries(skipped_queries, outfile_name[:-4] + "_skipped_queries.txt")
+        
+        query_result_cache.close()
+        print query_result_cache.report()
+        
+        if cooccurrence_prefilter is not None:
+            print cooccurrence_prefilter.report()
+        
+        instrumentation.write_report(outfile_name[:-4] + "_instrumentation.json")
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Tests for the decoding and metadata handling of create_master_index.py. Run with: python -m unittest discover tests'''
+
+from os import path
+import os, shutil, sys, tempfile, unittest
+
+#create_master_index.py lives in a sibling directory
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "create_master_index"))
+import create_master_index
+
+
+class FallbackEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.text_dir = tempfile.mkdtemp()
+        self.determine_string_encoding = create_master_index.determine_string_encoding
+        create_master_index.detected_directory_encodings.clear()
+
+    def tearDown(self):
+        create_master_index.determine_string_encoding = self.determine_string_encoding
+        create_master_index.detected_directory_encodings.clear()
+        shutil.rmtree(self.text_dir)
+
+    def write_text(self, filename, byte_string):
+        text_path = path.join(self.text_dir, filename)
+        with open(text_path, "wb") as text_out:
+            text_out.write(byte_string)
+        return text_path
+
+    def test_encoding_without_a_codec_falls_back_to_utf_8(self):
+        #chardet can name encodings (e.g. EUC-TW) that python has no codec for
+        create_master_index.determine_string_encoding = lambda string: "EUC-TW"
+        text_path = self.write_text("unknown.txt", "plain \xff text")
+
+        unicode_content, text_content_encoding = create_master_index.decode_text_file(text_path)
+        self.assertEqual(text_content_encoding, "utf-8")
+        self.assertEqual(unicode_content, u"plain  text")
+        self.assertEqual(create_master_index.detected_directory_encodings, {})
+
+    def test_ascii_sample_with_a_late_stray_byte_keeps_its_accents(self):
+        text_path = self.write_text("late.txt", "a" * 70000 + u"café naïve ".encode("utf-8") + "\xff" + "tail")
+
+        unicode_content, text_content_encoding = create_master_index.decode_text_file(text_path)
+        self.assertEqual(text_content_encoding, "utf-8")
+        self.assertEqual(unicode_content[70000:], u"café naïve tail")
+
+
+class MissingMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.text_dir = tempfile.mkdtemp()
+        self.lookup = create_master_index.metadata_registry.lookup
+
+    def tearDown(self):
+        create_master_index.metadata_registry.lookup = self.lookup
+        shutil.rmtree(self.text_dir)
+
+    def create_fields(self, text_metadata):
+        def lookup(corpus, filename):
+            if text_metadata is None:
+                raise KeyError((corpus, filename))
+            return text_metadata
+        create_master_index.metadata_registry.lookup = lookup
+
+        #the filename holds a four-digit number, as Project Gutenberg's do
+        text_path = path.join(self.text_dir, "1342.txt")
+        with open(text_path, "wb") as text_out:
+            text_out.write("It is a truth universally acknowledged")
+        return create_master_index.create_document_fields(text_path)
+
+    def test_missing_metadata_gives_no_year(self):
+        document_fields = self.create_fields(None)
+        self.assertEqual(document_fields["publication_year"], u"Metadata Missing. See: 1342")
+        self.assertNotIn("year", document_fields)
+
+    def test_found_metadata_gives_its_year(self):
+        document_fields = self.create_fields({"author": "Austen, Jane", "title": "Pride and Prejudice", "publication_year": "1813"})
+        self.assertEqual(document_fields["year"], 1813)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Tests for the request handling of query_service.py. Run with: python -m unittest discover tests'''
+
+from os import path
+import sys, unittest
+
+#query_service.py lives in a sibling directory
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "query_service"))
+import query_service
+
+
+class RequestWindowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query_service = query_service.QueryService()
+
+    def test_windows_terms_and_text(self):
+        request_windows = self.query_service.find_request_windows({"windows": [["The", "glory,"], "O'er the days"], "terms": "sweet love"})
+        self.assertEqual(request_windows, [[u"the", u"glory"], [u"o", u"er", u"the", u"days"], [u"sweet", u"love"]])
+
+    def test_malformed_requests_are_refused(self):
+        for search_request in [["the", "glory"], {"windows": "the glory"}, {"windows": [3]}, {"windows": [["the", None]]}, {"terms": 3}, {"text": ["the"]}]:
+            self.assertRaises(ValueError, self.query_service.find_request_windows, search_request)
+
+    def test_windows_without_words_are_refused(self):
+        for search_request in [{"windows": [["--"]]}, {"windows": [[]]}, {"windows": ["the", "..."]}, {"terms": []}, {"text": "--"}]:
+            self.assertRaises(ValueError, self.query_service.find_request_windows, search_request)
+
+
+class WindowErrorTest(unittest.TestCase):
+
+    class QueryResultCache(object):
+        def commit(self):
+            pass
+
+    def setUp(self):
+        self.search_window = query_service.search_master_index.search_window
+        self.query_service = query_service.QueryService()
+        self.query_service.query_result_cache = self.QueryResultCache()
+
+    def tearDown(self):
+        query_service.search_master_index.search_window = self.search_window
+
+    def test_failed_window_does_not_end_the_search(self):
+        def search_window(searcher, index_generation, query_result_cache, window_words, apply_cost_ceiling):
+            if window_words == [u"broken"]:
+                raise IOError("the text store is gone")
+            return ["row"], []
+        query_service.search_master_index.search_window = search_window
+
+        window_results = [window_result[:3] for window_result in self.query_service.search([[u"broken"], [u"glory"]])]
+        self.assertEqual(window_results, [(None, None, "IOError: the text store is gone"), (["row"], [], None)])
+        self.assertEqual(self.query_service.windows_served, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
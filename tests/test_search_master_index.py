@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Tests for the match verification of search_master_index.py. Run with: python -m unittest discover tests'''
+
+from os import path
+import sys, unittest
+
+#search_master_index.py lives in a sibling directory
+sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), "search_master_index"))
+import search_master_index
+
+
+class SharedVariantTest(unittest.TestCase):
+
+    #the groups for "loue" and "love" both accept "love", which occurs at position 5, while "loue" also occurs at 20 and "love" again at 6
+    term_groups = [[u"loue", u"love"], [u"love", u"loved"]]
+    position_lists = [[5, 20], [5, 6]]
+
+    def test_groups_partly_share_variants(self):
+        self.assertTrue(search_master_index.groups_partly_share_variants(self.term_groups))
+        self.assertFalse(search_master_index.groups_partly_share_variants([[u"the"], [u"the"], [u"glory"]]))
+        self.assertFalse(search_master_index.groups_partly_share_variants([[u"loue", u"love"], [u"glory"]]))
+
+    def test_shared_position_counts_for_one_group(self):
+        #position 5 alone would cover both groups, but it can only be given to one of them
+        self.assertEqual(search_master_index.find_minimum_distinct_window(self.position_lists, 8), (1, 5, 6, [5, 6]))
+
+    def test_assignment_hands_a_position_on(self):
+        #the first group can only use position 5, so the second group has to give it up for position 6
+        self.assertEqual(search_master_index.find_minimum_distinct_window([[5], [5, 6]], 8), (1, 5, 6, [5, 6]))
+
+    def test_window_wider_than_maximum_span(self):
+        self.assertEqual(search_master_index.find_minimum_distinct_window([[5], [5, 14]], 8), None)
+        self.assertEqual(search_master_index.find_minimum_distinct_window([[5], [5, 13]], 8), (8, 5, 13, [5, 13]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This module holds the text normalization shared by create_master_index.py and search_master_index.py, so both sides of the index turn text into
+words the same way.
+
+tokenize() splits text into exactly the tokens that the content field's analyzer (content_analyzer(), a StandardAnalyzer without a stoplist) indexes:
+runs of word characters, possibly joined by single dots, lowercased. The search side therefore looks up the same terms the index side wrote.
+
+remove_punctuation() strips every unicode punctuation character. Finding those characters means asking unicodedata about every code point up to
+maxunicode, which takes a noticeable fraction of a second, so the table is only built the first time it is needed and is then cached on disk (keyed
+to the unicode database version) for later runs.'''
+
+from sys import maxunicode
+import marshal, os, re, unicodedata
+
+#the same expression whoosh's StandardAnalyzer tokenizes with
+token_pattern = re.compile(r"\w+(\.?\w+)*", re.UNICODE)
+
+punctuation_table_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "punctuation_table_%s_%d.marshal" % (unicodedata.unidata_version, maxunicode))
+punctuation_table = None
+
+
+def content_analyzer():
+
+    '''return the analyzer used for the content field of the index'''
+
+    from whoosh import analysis
+    return analysis.StandardAnalyzer(expression=token_pattern, stoplist=None)
+
+
+def shingle_analyzer(shingle_size):
+
+    '''return the analyzer for the optional shingle field, which indexes every run of shingle_size consecutive content tokens as a single
+    space-separated term, positioned at its first token'''
+
+    from whoosh import analysis
+    return content_analyzer() | analysis.ShingleFilter(size=shingle_size, sep=" ")
+
+
+def tokenize(unicode_text):
+
+    '''return the lowercase tokens of unicode_text, exactly as content_analyzer() would index them'''
+
+    return [match.group(0).lower() for match in token_pattern.finditer(unicode_text)]
+
+
+def tokenize_batch(unicode_texts):
+
+    '''return the tokens of each of unicode_texts, as a list of lists'''
+
+    finditer = token_pattern.finditer
+    return [[match.group(0).lower() for match in finditer(unicode_text)] for unicode_text in unicode_texts]
+
+
+def load_punctuation_table():
+
+    '''return the table of unicode punctuation code points used by remove_punctuation, reading it from the on-disk cache if it's there and building
+    (and caching) it if not'''
+
+    global punctuation_table
+    if punctuation_table is None:
+        try:
+            with open(punctuation_table_path, "rb") as table_in:
+                punctuation_code_points = marshal.load(table_in)
+        except (IOError, EOFError, ValueError, TypeError):
+            punctuation_code_points = [i for i in xrange(maxunicode) if unicodedata.category(unichr(i)).startswith('P')]
+
+            #write the cache atomically; if the directory isn't writable, just keep the table we built
+            try:
+                with open(punctuation_table_path + ".tmp", "wb") as table_out:
+                    marshal.dump(punctuation_code_points, table_out)
+                os.rename(punctuation_table_path + ".tmp", punctuation_table_path)
+            except (IOError, OSError):
+                pass
+
+        punctuation_table = dict.fromkeys(punctuation_code_points)
+    return punctuation_table
+
+
+def remove_punctuation(unicode_text):
+
+    '''return unicode_text with all unicode punctuation removed'''
+
+    return unicode_text.translate(load_punctuation_table())
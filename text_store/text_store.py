@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''This module keeps the full text of every indexed document outside the whoosh index, so the index doesn't have to store (and merge) a copy of each
+book just so the search script can cut snippets from it.
+
+The texts are written as utf-8 to large append-only data files, which readers memory-map. A small sqlite catalog records, for each document path, the
+data file and byte range that hold its text, along with a checkpoint table: the byte offset of every checkpoint_characters-th character. Whoosh records
+the character range of each match, so a snippet is read by jumping to the checkpoint at or before its first character and decoding only the bytes up to
+the checkpoint after its last, without ever reading the rest of the book.
+
+Each process that writes to the store appends to a data file of its own, so the worker processes of a parallel build never share one. A document that
+is stored again (or deleted) simply has its catalog row replaced (or removed); the bytes it used to occupy are left in place until the next full rebuild.'''
+
+from array import array
+import mmap, os, sqlite3, tempfile
+
+
+class TextStore(object):
+
+    '''An append-only store of utf-8 document texts, with a catalog of character checkpoints for reading any character range of a text'''
+
+    def __init__(self, store_dir, checkpoint_characters=4096, maximum_data_file_bytes=1 << 30):
+        self.store_dir = store_dir
+        self.checkpoint_characters = checkpoint_characters
+        self.maximum_data_file_bytes = maximum_data_file_bytes
+
+        self.connection = None
+        self.data_file = None
+        self.data_file_name = None
+        self.process_id = None
+        self.mapped_data_files = {}
+
+    def connect(self):
+        '''Return a connection to the catalog. Worker processes forked from the indexer can't share their parent's connection or data file, so each process opens its own'''
+        if self.connection is None or self.process_id != os.getpid():
+            if not os.path.isdir(self.store_dir):
+                os.makedirs(self.store_dir)
+
+            #parallel builds write to the catalog from every worker, so wait for each other's commits rather than failing
+            self.connection = sqlite3.connect(os.path.join(self.store_dir, "catalog.sqlite"), timeout=60)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS texts (text_path TEXT PRIMARY KEY, data_file TEXT, byte_offset INTEGER, byte_length INTEGER, character_length INTEGER, checkpoint_characters INTEGER, checkpoints BLOB)")
+            self.connection.commit()
+
+            self.data_file = None
+            self.process_id = os.getpid()
+            self.mapped_data_files = {}
+        return self.connection
+
+    def open_data_file(self):
+        '''Return the data file this process appends to, starting a new one if there is none yet or the current one is full'''
+        if self.data_file is None or self.data_file.tell() >= self.maximum_data_file_bytes:
+            if self.data_file is not None:
+                self.data_file.close()
+            data_file_descriptor, data_file_path = tempfile.mkstemp(prefix="texts_", suffix=".dat", dir=self.store_dir)
+            self.data_file = os.fdopen(data_file_descriptor, "ab")
+            self.data_file_name = os.path.basename(data_file_path)
+        return self.data_file
+
+    def put(self, text_path, unicode_text):
+        '''Append unicode_text to the store as the text of text_path, replacing any text stored for it before. The catalog row is committed at once, so
+        a worker holds the catalog's write lock only while it writes the row, and never while it indexes its next text'''
+        connection = self.connect()
+        data_file = self.open_data_file()
+
+        #record the byte offset of every checkpoint_characters-th character, encoding the text one checkpoint at a time
+        checkpoints = array("I")
+        encoded_chunks = []
+        byte_length = 0
+        for k in xrange(0, len(unicode_text), self.checkpoint_characters):
+            checkpoints.append(byte_length)
+            encoded_chunks.append( unicode_text[k:k+self.checkpoint_characters].encode("utf-8") )
+            byte_length += len(encoded_chunks[-1])
+
+        byte_offset = data_file.tell()
+        data_file.write("".join(encoded_chunks))
+        data_file.flush()
+
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (text_path, self.data_file_name, byte_offset, byte_length, len(unicode_text), self.checkpoint_characters, sqlite3.Binary(checkpoints.tostring())))
+
+    def delete(self, text_path):
+        '''Remove text_path from the catalog, committing the removal at once'''
+        with self.connect() as connection:
+            connection.execute("DELETE FROM texts WHERE text_path = ?", (text_path,))
+
+    def commit(self):
+        '''Sync this process's data file to disk and commit the catalog, so that every text stored so far survives a crash'''
+        connection = self.connect()
+        if self.data_file is not None:
+            self.data_file.flush()
+            os.fsync(self.data_file.fileno())
+        connection.commit()
+
+    def map_data_file(self, data_file_name, minimum_size):
+        '''Return a memory map of the named data file that covers at least its first minimum_size bytes'''
+        mapped_data_file = self.mapped_data_files.get(data_file_name)
+
+        #a data file still being appended to may have grown since it was mapped, so map it again
+        if mapped_data_file is None or len(mapped_data_file) < minimum_size:
+            with open(os.path.join(self.store_dir, data_file_name), "rb") as data_file_in:
+                mapped_data_file = mmap.mmap(data_file_in.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped_data_files[data_file_name] = mapped_data_file
+        return mapped_data_file
+
+    def read_characters(self, text_path, startchar, endchar):
+        '''Return characters startchar to endchar of the text stored for text_path, as unicode. Raises KeyError if no text is stored for it'''
+        row = self.connect().execute("SELECT data_file, byte_offset, byte_length, character_length, checkpoint_characters, checkpoints FROM texts WHERE text_path = ?", (text_path,)).fetchone()
+        if row is None:
+            raise KeyError(text_path)
+        data_file_name, byte_offset, byte_length, character_length, checkpoint_characters, checkpoint_bytes = row
+
+        startchar = max(0, startchar)
+        endchar = min(endchar, character_length)
+        if startchar >= endchar:
+            return u""
+
+        checkpoints = array("I")
+        checkpoints.fromstring(str(checkpoint_bytes))
+
+        #decode from the checkpoint at or before startchar up to the checkpoint after endchar (or the end of the text)
+        first_checkpoint = startchar // checkpoint_characters
+        last_checkpoint = (endchar - 1) // checkpoint_characters + 1
+        byte_start = checkpoints[first_checkpoint]
+        byte_end = checkpoints[last_checkpoint] if last_checkpoint < len(checkpoints) else byte_length
+
+        mapped_data_file = self.map_data_file(data_file_name, byte_offset + byte_length)
+        decoded_text = mapped_data_file[byte_offset + byte_start : byte_offset + byte_end].decode("utf-8")
+
+        first_character = first_checkpoint * checkpoint_characters
+        return decoded_text[startchar - first_character : endchar - first_character]
+
+    def close(self):
+        '''Close the data file, the memory maps, and the catalog'''
+        if self.data_file is not None:
+            self.data_file.close()
+            self.data_file = None
+        for mapped_data_file in self.mapped_data_files.values():
+            mapped_data_file.close()
+        self.mapped_data_files = {}
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None